@@ -0,0 +1,78 @@
+'''Compares building a page of the /image listing with Photo.to_json() and
+jsonify against splicing together cached fragments.
+
+    python bench/bench_json.py [PAGES]
+
+Runs against a scratch library in a temporary directory, unless
+INTRUSTDPHOTOS is set.'''
+
+import os
+import sys
+import time
+import hashlib
+import tempfile
+import statistics
+
+if os.getenv('INTRUSTDPHOTOS') is None:
+    os.environ['INTRUSTDPHOTOS'] = tempfile.mkdtemp(prefix='photos-bench-')
+
+from flask import jsonify
+from sqlalchemy.orm import joinedload
+
+from intrustd.photo.app import app
+from intrustd.photo.schema import engine, session_scope, Photo, order_photos_default
+from intrustd.photo.fragments import photo_fragments, photo_list_json
+
+PAGE_SIZE = 100
+DEFAULT_PAGES = 200
+
+def make_library(count):
+    rows = [ { 'id': hashlib.sha256(str(i).encode('ascii')).hexdigest(),
+               'description': 'Photo number {}'.format(i) }
+             for i in range(count) ]
+
+    with engine.begin() as connection:
+        connection.execute('''
+          INSERT OR IGNORE INTO photo(id, description, created_on, modified_on, taken_on,
+                                      width, height, placeholder, video, state)
+          VALUES (:id, :description, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP,
+                  4032, 3024, 'LEHV6nWB2yk8pyo0adR*.7kCMdnj', 0, 'ready')
+        ''', rows)
+
+def fetch_page(session):
+    photos = order_photos_default(session.query(Photo)) \
+        .options(joinedload(Photo.video_formats))
+    return photos[:PAGE_SIZE]
+
+def uncached(photos):
+    return jsonify({ 'images': [ photo.build_json() for photo in photos ],
+                     'total': len(photos) }).get_data()
+
+def spliced(photos):
+    return photo_list_json('images', photos, { 'total': len(photos) })
+
+def time_encoding(encode, pages):
+    timings = []
+    with session_scope() as session:
+        photos = fetch_page(session)
+
+        for _ in range(pages):
+            start = time.perf_counter()
+            encode(photos)
+            timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings) * 1000
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PAGES
+
+    make_library(PAGE_SIZE)
+
+    with app.app_context():
+        print('to_json + jsonify: {:.3f} ms/page'.format(time_encoding(uncached, pages)))
+        print('cached fragments:  {:.3f} ms/page'.format(time_encoding(spliced, pages)))
+
+    print('fragment cache: {} hits, {} misses'.format(photo_fragments.hits, photo_fragments.misses))
+
+if __name__ == '__main__':
+    main()
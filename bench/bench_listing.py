@@ -0,0 +1,98 @@
+'''Measures how long the /image listing takes to fetch a page as the
+library grows. Page latency should stay flat, since each page is a range
+scan of photo_created_order.
+
+    python bench/bench_listing.py [SIZE ...]
+
+Runs against a scratch library in a temporary directory, unless
+INTRUSTDPHOTOS is set.'''
+
+import os
+import sys
+import time
+import random
+import hashlib
+import tempfile
+import statistics
+
+from datetime import datetime, timedelta
+
+if os.getenv('INTRUSTDPHOTOS') is None:
+    os.environ['INTRUSTDPHOTOS'] = tempfile.mkdtemp(prefix='photos-bench-')
+
+from sqlalchemy.orm import joinedload
+
+from intrustd.photo.schema import engine, session_scope, Photo, \
+    order_photos_default, filter_photos_after
+from intrustd.photo.util import datetime_sql
+
+DEFAULT_SIZES = [ 1000, 10000, 100000, 500000 ]
+PAGE_SIZE = 100
+REPEAT = 20
+
+EPOCH = datetime(2010, 1, 1)
+
+def grow_library(count, target):
+    rows = []
+    for i in range(count, target):
+        photo_id = hashlib.sha256(str(i).encode('ascii')).hexdigest()
+        # Bursts of photos share a timestamp, to exercise the id tie-break
+        when = datetime_sql(EPOCH + timedelta(seconds=random.randint(0, target * 10) // 3))
+        rows.append({ 'id': photo_id, 'when': when })
+
+    with engine.begin() as connection:
+        connection.execute('''
+          INSERT INTO photo(id, description, created_on, modified_on, taken_on, video, state)
+          VALUES (:id, '', :when, :when, :when, 0, 'ready')
+        ''', rows)
+
+def fetch_page(session, anchor=None):
+    photos = order_photos_default(session.query(Photo))
+    if anchor is not None:
+        photos = filter_photos_after(photos, *anchor)
+
+    photos = photos.options(joinedload(Photo.tags)).\
+        options(joinedload(Photo.video_formats))
+
+    return photos[:PAGE_SIZE]
+
+def time_page(anchor):
+    timings = []
+    for _ in range(REPEAT):
+        with session_scope() as session:
+            start = time.perf_counter()
+            fetch_page(session, anchor)
+            timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings) * 1000
+
+def main():
+    sizes = [ int(size) for size in sys.argv[1:] ] or DEFAULT_SIZES
+
+    with engine.connect() as connection:
+        plan = connection.execute('''
+          EXPLAIN QUERY PLAN
+          SELECT id FROM photo
+          WHERE created_on <= ? AND (created_on < ? OR id > ?)
+          ORDER BY created_on DESC, id ASC LIMIT 100
+        ''', ('2020-01-01 00:00:00', '2020-01-01 00:00:00', '0' * 64)).fetchall()
+        print('Query plan:', '; '.join(row[-1] for row in plan))
+
+    print('{:>10} {:>12} {:>12} {:>12}'.format('photos', 'first (ms)', 'middle (ms)', 'last (ms)'))
+
+    count = 0
+    for size in sizes:
+        grow_library(count, size)
+        count = size
+
+        with session_scope() as session:
+            ordered = order_photos_default(session.query(Photo.id, Photo.created_on))
+            middle = ordered.offset(size // 2).first()
+            last = ordered.offset(max(0, size - PAGE_SIZE - 1)).first()
+
+        anchors = [ None, tuple(middle), tuple(last) ]
+
+        print('{:>10} {:>12.2f} {:>12.2f} {:>12.2f}'.format(size, *(time_page(anchor) for anchor in anchors)))
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,10 @@ from .schema import session_scope, Photo, PhotoTag, VideoFormat
 from .perms import perms, CommentAllPerm, ViewAllPerm, GalleryPerm, UploadPerm, ViewPerm, CommentPerm
 from .app import app, cache_control, no_cache, no_store
 
-from . import video, photos, albums, upload, tags
+from . import video, photos, albums, upload, tags, thumbnails, resumable, timeline, changes
+from .pipeline import pipeline
+from .resumable import start_session_sweeper
+from .thumbnails import variant_cache, thumbnail_queue
 
 from intrustd.permissions import Placeholder, mkperm
 from intrustd.tasks import schedule_command, get_scheduled_command_status
@@ -20,6 +23,11 @@ from intrustd.tasks import schedule_command, get_scheduled_command_status
 def main(debug = False, port=80):
     print("Starting server")
 
+    thumbnail_queue.start()
+    variant_cache.start()
+    pipeline.resume()
+    start_session_sweeper()
+
     if debug:
         bundle = sys.argv[1]
 
@@ -2,7 +2,6 @@ from .app import app, no_cache, NotModified
 from .perms import perms, CreateAlbumsPerm, ViewAlbumsPerm, ViewAlbumPerm
 from .schema import session_scope, Photo, Album, AlbumItem
 from .util import MAX_RANKS
-from .photos import _ensure_photo_attrs
 
 from intrustd.permissions import mkperm, Placeholder
 
@@ -137,10 +136,6 @@ def album(album_id=None, cur_perms=None):
 
                 album.name = data['name']
 
-            for item in album.items:
-                if item.photo is not None:
-                    _ensure_photo_attrs(item.photo)
-
             return jsonify(album.to_json())
 
         else:
@@ -1,15 +1,43 @@
-from flask import Flask, request, jsonify
-from .util import get_photo_dir
+from flask import Flask, Request, request, jsonify
+from .util import get_photo_dir, HashingSpool, VARIANT_DIR
 from .perms import perms, GalleryPerm, CommentAllPerm, \
-    ViewAlbumsPerm, CreateAlbumsPerm, UploadPerm
+    ViewAlbumsPerm, CreateAlbumsPerm, UploadPerm, close_permission_resolver
 
 from intrustd.permissions import MissingPermissionsError
 
+import os
+
 temp_photo_dir = get_photo_dir('.tmp')
+os.makedirs(temp_photo_dir, exist_ok=True)
+os.makedirs(get_photo_dir(VARIANT_DIR), exist_ok=True)
+
+class PhotoRequest(Request):
+    def new_spool(self):
+        # Handlers claim the spool; anything left is removed once the
+        # request is done.
+        spool = HashingSpool(app.config['UPLOAD_FOLDER'])
+        if not hasattr(self, 'spools'):
+            self.spools = []
+        self.spools.append(spool)
+        return spool
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        # Spool uploaded files next to the photos, hashing them as they
+        # arrive
+        return self.new_spool()
 
 app = Flask(__name__)
+app.request_class = PhotoRequest
 app.config['UPLOAD_FOLDER'] = temp_photo_dir
 app.config['MAX_CONTENT_LENGTH'] = 4294967296
+app.config['THUMBNAIL_WORKERS'] = 2
+app.config['THUMBNAIL_QUEUE_SIZE'] = 1024
+app.config['THUMBNAIL_CACHE_BYTES'] = 2147483648
+app.config['THUMBNAIL_CACHE_SWEEP_INTERVAL'] = 300
+app.config['PIPELINE_WORKERS'] = 2
+app.config['UPLOAD_SESSION_TIMEOUT'] = 86400
+app.config['UPLOAD_SESSION_SWEEP_INTERVAL'] = 3600
 # app.config['ALLOWED_EXTENSIONS'] = set(['jpg', 'jpeg', 'png', 'tiff', 'gif'])
 
 def cache_control(s):
@@ -27,6 +55,15 @@ def cache_control(s):
 no_cache = cache_control('no-cache')
 no_store = cache_control('no-store')
 
+@app.teardown_request
+def discard_spools(exc):
+    for spool in getattr(request, 'spools', []):
+        spool.discard()
+
+@app.teardown_request
+def discard_permission_resolver(exc):
+    close_permission_resolver()
+
 class NotModified(Exception):
     def __init__(self):
         pass
@@ -0,0 +1,119 @@
+import argparse
+import os
+
+from multiprocessing import Pool
+
+from PIL import Image
+
+from sqlalchemy import or_
+
+from .util import get_photo_path, get_raw_photo_path
+from .schema import session_scope, Photo, PHOTO_PROCESSING
+from .placeholder import make_placeholder
+from .exif import read_exif, apply_exif
+
+import magic
+
+# Each backfill reads an attribute from a file in a worker process, then
+# applies it to the photo in the main one
+
+def _apply_placeholder(photo, placeholder):
+    photo.placeholder = placeholder
+
+def _read_dims(path):
+    with Image.open(path) as im:
+        return im.size
+
+def _apply_dims(photo, dims):
+    photo.width, photo.height = dims
+
+def _read_type(path):
+    return magic.from_file(path, mime=True)
+
+def _apply_type(photo, mime_type):
+    photo.mime_type = mime_type
+
+# name -> (filter selecting photos that need it, whether it applies to
+#          videos, read function, apply function)
+BACKFILLS = { 'dims': (or_(Photo.width.is_(None), Photo.height.is_(None)), False,
+                       _read_dims, _apply_dims),
+              'types': (Photo.mime_type.is_(None), True,
+                        _read_type, _apply_type),
+              'placeholders': (Photo.placeholder.is_(None), False,
+                               make_placeholder, _apply_placeholder),
+              'exif': (Photo.orientation.is_(None), False,
+                       read_exif, apply_exif) }
+
+args = argparse.ArgumentParser(description='Fill in photo attributes that older libraries are missing')
+args.add_argument('what', metavar='WHAT', nargs='*', choices=list(BACKFILLS),
+                  default=list(BACKFILLS),
+                  help='Attributes to fill in ({}). Defaults to all'.format(', '.join(BACKFILLS)))
+args.add_argument('--batch-size', dest='batch_size', type=int, default=100,
+                  help='Number of photos to update per transaction')
+args.add_argument('--jobs', '-j', dest='jobs', type=int, default=os.cpu_count() or 1,
+                  help='Number of processes reading files. Defaults to the number of CPUs')
+
+def _read(job):
+    what, photo_id, path = job
+    _, _, read, _ = BACKFILLS[what]
+
+    try:
+        return photo_id, read(path), None
+    except Exception as e:
+        return photo_id, None, str(e)
+
+def backfill(what, batch_size, pool):
+    '''Fills in what for every photo missing it. Photos are done in order
+    of id, and each batch is committed as it is done, so an interrupted
+    backfill picks up where it left off when run again.'''
+
+    missing, for_videos, _, apply = BACKFILLS[what]
+
+    done = 0
+    last_id = ''
+
+    while True:
+        with session_scope() as session:
+            batch = session.query(Photo) \
+                           .filter(missing,
+                                   Photo.state != PHOTO_PROCESSING,
+                                   Photo.id > last_id) \
+                           .order_by(Photo.id.asc())
+            if not for_videos:
+                batch = batch.filter(Photo.video == False)
+            batch = batch.limit(batch_size).all()
+
+            if len(batch) == 0:
+                break
+
+            photos = { photo.id: photo for photo in batch }
+            jobs = []
+            for photo in batch:
+                path = get_raw_photo_path(photo) if for_videos else get_photo_path(photo.id)
+                if os.path.exists(path):
+                    jobs.append((what, photo.id, path))
+
+            for photo_id, value, error in pool.imap_unordered(_read, jobs):
+                if error is None:
+                    try:
+                        apply(photos[photo_id], value)
+                    except Exception as e:
+                        error = str(e)
+
+                if error is not None:
+                    print("Could not update", what, "for", photo_id, error)
+
+            last_id = batch[-1].id
+            done += len(batch)
+
+        print("{}: processed".format(what), done, "photos")
+
+def main():
+    opts = args.parse_args()
+
+    with Pool(processes=max(1, opts.jobs)) as pool:
+        for what in opts.what:
+            backfill(what, opts.batch_size, pool)
+
+if __name__ == "__main__":
+    main()
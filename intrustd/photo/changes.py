@@ -0,0 +1,121 @@
+from .app import app, no_store
+from .perms import perms, GalleryPerm, ViewPerm, viewable_scope
+from .schema import session_scope, Photo, Album, AlbumItem, ChangeLog, \
+    CHANGE_PHOTO, CHANGE_TAG, CHANGE_ALBUM, CHANGE_ALBUM_ITEM
+
+from flask import jsonify, request
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+MAX_CHANGES = 1000
+
+# Number of ids looked up per query
+LOOKUP_CHUNK = 500
+
+def _load(session, query, column, ids):
+    ids = list(ids)
+    found = {}
+    for i in range(0, len(ids), LOOKUP_CHUNK):
+        for row in query.filter(column.in_(ids[i:i + LOOKUP_CHUNK])):
+            found[getattr(row, column.key)] = row
+    return found
+
+@app.route('/changes', methods=['GET'])
+@perms.require(GalleryPerm, pass_permissions=True)
+@no_store
+def changes(cur_perms=None):
+    '''Changes to photos, tags, albums and album items since ?since, a
+    cursor returned by an earlier call. Without ?since, only returns the
+    current cursor.'''
+
+    since = request.args.get('since')
+    limit = request.args.get('limit', MAX_CHANGES)
+
+    try:
+        limit = min(MAX_CHANGES, int(limit))
+    except ValueError:
+        return jsonify({'error': '{} is not a number'.format(limit)}), 400
+
+    if limit <= 0:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    with session_scope() as session:
+        if since is None:
+            cursor = session.query(func.max(ChangeLog.seq)).scalar() or 0
+            return jsonify({ 'changes': [], 'cursor': cursor, 'more': False })
+
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({'error': 'invalid ?since param'}), 400
+
+        log = session.query(ChangeLog).filter(ChangeLog.seq > since) \
+                                      .order_by(ChangeLog.seq.asc()) \
+                                      .limit(limit + 1).all()
+
+        more = len(log) > limit
+        log = log[:limit]
+        cursor = log[-1].seq if len(log) > 0 else since
+
+        view_scope = viewable_scope(cur_perms)
+        if view_scope is not None:
+            visible_photos = view_scope.photo_ids()
+
+        def is_visible(entry):
+            if view_scope is None:
+                return True
+            elif entry.kind == CHANGE_PHOTO:
+                if entry.deleted:
+                    # No longer in any scope. Album items carry the deletion
+                    # of shared albums, but a photo granted on its own has
+                    # only its grant left to go by.
+                    return ViewPerm(photo_id=entry.key) in cur_perms
+                return entry.key in visible_photos
+            elif entry.kind == CHANGE_TAG:
+                return entry.parent in visible_photos
+            elif entry.kind == CHANGE_ALBUM:
+                return entry.key in view_scope.albums
+            else:
+                return entry.parent in view_scope.albums
+
+        log = [ entry for entry in log if is_visible(entry) ]
+
+        def current(kind, query, column):
+            return _load(session, query, column,
+                         (entry.key for entry in log
+                          if entry.kind == kind and not entry.deleted))
+
+        photos = current(CHANGE_PHOTO,
+                         session.query(Photo).options(joinedload(Photo.video_formats)),
+                         Photo.id)
+        albums = current(CHANGE_ALBUM, session.query(Album), Album.album_id)
+        items = current(CHANGE_ALBUM_ITEM, session.query(AlbumItem), AlbumItem.id)
+
+        result = []
+        for entry in log:
+            change = { 'kind': entry.kind, 'deleted': entry.deleted }
+
+            if entry.kind == CHANGE_TAG:
+                change['photo'] = entry.parent
+                change['tag'] = entry.key
+                result.append(change)
+                continue
+
+            change['id'] = entry.key
+            if entry.kind == CHANGE_ALBUM_ITEM:
+                change['album'] = entry.parent
+
+            if not entry.deleted:
+                current_row = { CHANGE_PHOTO: photos,
+                                CHANGE_ALBUM: albums,
+                                CHANGE_ALBUM_ITEM: items }[entry.kind].get(entry.key)
+                if current_row is None:
+                    # Deleted later on in the log
+                    continue
+
+                change[entry.kind] = current_row.to_json()
+
+            result.append(change)
+
+        return jsonify({ 'changes': result, 'cursor': cursor, 'more': more })
@@ -0,0 +1,106 @@
+from PIL import Image
+
+from datetime import datetime, timedelta
+
+EXIF_ORIENTATION = 0x0112
+EXIF_MAKE = 0x010F
+EXIF_MODEL = 0x0110
+EXIF_DATETIME = 0x0132
+EXIF_IFD = 0x8769
+EXIF_GPS_IFD = 0x8825
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_DATETIME_DIGITIZED = 0x9004
+EXIF_OFFSET_TIME = 0x9010
+EXIF_OFFSET_TIME_ORIGINAL = 0x9011
+EXIF_OFFSET_TIME_DIGITIZED = 0x9012
+
+# Orientation of an image without rotation, used when there is no tag
+DEFAULT_ORIENTATION = 1
+
+def _exif_str(value):
+    if value is None:
+        return ''
+    elif isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return str(value).strip('\x00 ')
+
+def _parse_exif_offset(value):
+    # +HH:MM, as written to the OffsetTime tags
+    value = _exif_str(value)
+    if len(value) != 6 or value[0] not in '+-' or value[3] != ':':
+        return None
+
+    try:
+        offset = timedelta(hours=int(value[1:3]), minutes=int(value[4:6]))
+    except ValueError:
+        return None
+
+    return -offset if value[0] == '-' else offset
+
+def _parse_exif_datetime(value, offset):
+    '''Parses an EXIF timestamp, which is in the local time of the camera.
+    If offset gives the UTC offset of that, the result is in UTC like
+    every other time in the database. Otherwise it is the local time as
+    is, since that is closer than anything else available.'''
+
+    try:
+        taken = datetime.strptime(_exif_str(value), "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+
+    offset = _parse_exif_offset(offset)
+    if offset is not None:
+        taken -= offset
+
+    return taken
+
+def read_exif(path):
+    '''Returns the capture metadata of the image at path. Images without
+    EXIF data give None for everything but orientation.'''
+
+    with Image.open(path) as im:
+        # Malformed EXIF data is treated like none at all
+        try:
+            exif = im.getexif()
+        except Exception:
+            exif = Image.Exif()
+
+        try:
+            exif_ifd = exif.get_ifd(EXIF_IFD)
+        except Exception:
+            exif_ifd = {}
+
+    taken = None
+    for value, offset in ((exif_ifd.get(EXIF_DATETIME_ORIGINAL),
+                           exif_ifd.get(EXIF_OFFSET_TIME_ORIGINAL)),
+                          (exif_ifd.get(EXIF_DATETIME_DIGITIZED),
+                           exif_ifd.get(EXIF_OFFSET_TIME_DIGITIZED)),
+                          (exif.get(EXIF_DATETIME),
+                           exif_ifd.get(EXIF_OFFSET_TIME))):
+        taken = _parse_exif_datetime(value, offset)
+        if taken is not None:
+            break
+
+    make = _exif_str(exif.get(EXIF_MAKE))
+    model = _exif_str(exif.get(EXIF_MODEL))
+    if model.startswith(make):
+        camera = model
+    else:
+        camera = '{} {}'.format(make, model).strip()
+
+    try:
+        orientation = int(exif.get(EXIF_ORIENTATION, DEFAULT_ORIENTATION))
+    except (TypeError, ValueError):
+        orientation = DEFAULT_ORIENTATION
+
+    return { 'taken': taken,
+             'orientation': orientation,
+             'camera': camera or None,
+             'gps': EXIF_GPS_IFD in exif }
+
+def apply_exif(photo, info):
+    # Photos without a capture time sort by when they were uploaded
+    photo.taken_on = info['taken'] or photo.created_on
+    photo.orientation = info['orientation']
+    photo.camera = info['camera']
+    photo.has_gps = info['gps']
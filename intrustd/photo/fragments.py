@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from datetime import datetime
+
+import threading
+import json
+
+# Number of photos whose JSON is kept
+MAX_FRAGMENTS = 20000
+
+def encode_json(data):
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+class FragmentCache(object):
+    '''The JSON of recently sent photos, both as a dict and encoded, so
+    that listings and albums don't rebuild it on every request.
+
+    Entries are checked against Photo.json_key() on every lookup. That
+    includes modified_on, but also every other value the JSON is built
+    from, since modified_on only has a resolution of seconds.'''
+
+    def __init__(self, max_entries=MAX_FRAGMENTS):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, photo):
+        '''Returns the JSON of photo as a (dict, bytes) pair. The dict must
+        not be modified.'''
+
+        # Photos that haven't been flushed yet hold SQL defaults instead of
+        # timestamps
+        if not all(isinstance(value, datetime)
+                   for value in (photo.created_on, photo.modified_on, photo.taken_on)):
+            data = photo.build_json()
+            return data, encode_json(data)
+
+        key = photo.json_key()
+        with self._lock:
+            entry = self._entries.get(photo.id)
+            if entry is not None and entry[0] == key:
+                self._entries.move_to_end(photo.id)
+                self.hits += 1
+                return entry[1], entry[2]
+
+            self.misses += 1
+
+        data = photo.build_json()
+        encoded = encode_json(data)
+
+        with self._lock:
+            self._entries[photo.id] = (key, data, encoded)
+            self._entries.move_to_end(photo.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return data, encoded
+
+photo_fragments = FragmentCache()
+
+def photo_list_json(name, photos, data):
+    '''Encodes data, with the JSON of photos as the list under name. The
+    cached JSON of each photo is copied into the result as is.'''
+
+    items = b'[' + b','.join(photo.to_json_bytes() for photo in photos) + b']'
+    head = b'{' + encode_json(name) + b':' + items
+
+    if len(data) == 0:
+        return head + b'}'
+    else:
+        return head + b',' + encode_json(data)[1:]
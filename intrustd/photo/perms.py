@@ -1,9 +1,73 @@
 from intrustd.permissions import Permissions
 
-from .schema import session_scope, AlbumItem, Album
+from .schema import Session, Photo, AlbumItem, Album
+
+from flask import g, has_request_context
+
+from sqlalchemy import or_
+
+from contextlib import contextmanager
 
 perms = Permissions('intrustd+perm://photos.intrustd.com')
 
+class PermissionResolver(object):
+    '''Answers the database questions asked by permission checks. Within a
+    request, one resolver is shared by every check, so each album is
+    looked up at most once no matter how many photos are checked.'''
+
+    def __init__(self):
+        self._session = None
+        self._albums = {}
+        self._album_photos = {}
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = Session()
+        return self._session
+
+    def album(self, album_id):
+        if album_id not in self._albums:
+            self._albums[album_id] = self.session.query(Album).get(album_id)
+        return self._albums[album_id]
+
+    def album_photos(self, album_id):
+        photos = self._album_photos.get(album_id)
+        if photos is None:
+            photos = frozenset(photo_id for photo_id, in
+                               self.session.query(AlbumItem.photo_id)
+                                   .filter(AlbumItem.album_id == album_id,
+                                           AlbumItem.photo_id != None))
+            self._album_photos[album_id] = photos
+        return photos
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+@contextmanager
+def permission_resolver():
+    '''The resolver of the current request, or a new one outside of
+    requests'''
+
+    if has_request_context():
+        resolver = g.get('permission_resolver')
+        if resolver is None:
+            resolver = g.permission_resolver = PermissionResolver()
+        yield resolver
+    else:
+        resolver = PermissionResolver()
+        try:
+            yield resolver
+        finally:
+            resolver.close()
+
+def close_permission_resolver():
+    resolver = g.pop('permission_resolver', None)
+    if resolver is not None:
+        resolver.close()
+
 CommentAllPerm = perms.permission('/comment')
 ViewAllPerm = perms.permission('/view')
 GalleryPerm = perms.permission('/gallery')
@@ -22,12 +86,9 @@ class ViewPerm(object):
         for _ in search.search(ViewAlbumsPerm):
             search.satisfy()
 
-        for perm in search.search(ViewAlbumPerm):
-            with session_scope() as session:
-                item = session.query(AlbumItem) \
-                              .filter(AlbumItem.album_id==perm.album_id,
-                                      AlbumItem.photo_id==self.photo_id).first()
-                if item is not None:
+        with permission_resolver() as resolver:
+            for perm in search.search(ViewAlbumPerm):
+                if self.photo_id in resolver.album_photos(perm.album_id):
                     search.satisfy()
 
 @perms.permission('/upload/guest')
@@ -82,6 +143,57 @@ class UploadAlbumAsGuestPerm(object):
         for _ in search.search(CreateAlbumsPerm):
             search.satisfy()
 
+class ViewScope(object):
+    '''The photos that can be viewed by someone who can't view them all:
+    those in the albums they were granted, and those granted one at a
+    time.'''
+
+    def __init__(self, albums, photos):
+        self.albums = frozenset(albums)
+        self.photos = frozenset(photos)
+
+    @property
+    def key(self):
+        return (tuple(sorted(self.albums)), tuple(sorted(self.photos)))
+
+    def filter_photos(self, photos, session):
+        in_albums = session.query(AlbumItem.photo_id) \
+                           .filter(AlbumItem.album_id.in_(self.albums))
+        return photos.filter(or_(Photo.id.in_(self.photos),
+                                 Photo.id.in_(in_albums)))
+
+    def photo_ids(self):
+        with permission_resolver() as resolver:
+            photo_ids = set(self.photos)
+            for album_id in self.albums:
+                photo_ids |= resolver.album_photos(album_id)
+            return photo_ids
+
+def viewable_scope(cur_perms):
+    '''The ViewScope of cur_perms, or None if it can view every photo.
+
+    Permissions can only be checked, not listed, so every album is
+    checked, and then every photo outside the albums found. Only viewers
+    restricted to what was shared with them pay for this.'''
+
+    if perms.debug or ViewAllPerm in cur_perms or ViewAlbumsPerm in cur_perms:
+        return None
+
+    with permission_resolver() as resolver:
+        session = resolver.session
+
+        albums = set(album_id for album_id, in session.query(Album.album_id)
+                     if ViewAlbumPerm(album_id=album_id) in cur_perms)
+
+        in_albums = session.query(AlbumItem.photo_id) \
+                           .filter(AlbumItem.album_id.in_(albums),
+                                   AlbumItem.photo_id != None)
+        photos = set(photo_id for photo_id, in session.query(Photo.id)
+                                                   .filter(~Photo.id.in_(in_albums))
+                     if ViewPerm(photo_id=photo_id) in cur_perms)
+
+    return ViewScope(albums=albums, photos=photos)
+
 def image_thumbnail_gallery(imgs):
     gallery = []
     for img in imgs:
@@ -175,7 +287,7 @@ def view_album_permission(search):
     perms = set()
     descs = []
 
-    with session_scope() as session:
+    with permission_resolver() as resolver:
         for p in search.search(ViewAlbumPerm):
             album_id = p.album_id
 
@@ -185,7 +297,7 @@ def view_album_permission(search):
                 perms.add(upload_p)
                 can_upload = True
 
-            album = session.query(Album).get(album_id)
+            album = resolver.album(album_id)
             if album is None:
                 continue
 
@@ -1,9 +1,14 @@
 from .app import app, no_store, NotModified
 from .perms import perms, CommentPerm, ViewPerm, UploadPerm
 from .schema import session_scope, Photo, PhotoTag, VideoFormat, \
-    calc_counts_until, calc_counts_from
+    SORT_KEYS
+from .ranks import calc_counts_until, calc_counts_from
 from .util import get_raw_photo_path, get_photo_path, get_photo_files, \
-    ZIP_MIMETYPE, M3U8_MIMETYPE
+    ZIP_MIMETYPE, M3U8_MIMETYPE, WEBP_MIMETYPE, VARIANT_FORMATS, \
+    IMMUTABLE_CACHE_CONTROL, photo_id_re
+from .thumbnails import ensure_variant, round_size
+from .placeholder import make_placeholder
+from .exif import read_exif, apply_exif
 
 from flask import jsonify, send_from_directory, send_file, request, abort, Response
 
@@ -11,12 +16,18 @@ from PIL import Image
 
 from intrustd.permissions import Placeholder, mkperm
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import re
+import uuid
 import zipstream
-import math
 import magic
 import os
 
+MAX_THUMBNAIL_BATCH = 200
+
+_thumbnail_batch_executor = ThreadPoolExecutor(max_workers=4)
+
 tag_re = re.compile('#\\[[#a-zA-Z0-9_\\-\'"]+\\]\\(([A-Za-z0-9_\\-\'"]+)\\)')
 
 CONTENT_TYPE_TO_EXTENSION = {
@@ -34,21 +45,30 @@ CONTENT_TYPE_TO_EXTENSION = {
     'video/3gpp2': '3g2'
 }
 
-def auto_resize(max_dim, orig_path, output_path):
-    with Image.open(orig_path) as im:
-        im.thumbnail((max_dim, max_dim))
-        im.save(output_path, "JPEG")
-
-def round_size(size):
-    new_size = int(2 ** math.ceil(math.log(size, 2)))
-    return max(new_size, 100)
-
-def _ensure_photo_attrs(p):
-    if p.width is None or p.height is None:
-        _update_photo_dims(p)
-
-    if p.mime_type is None:
-        _update_photo_type(p)
+def _negotiate_variant_format():
+    # Only serve WebP to clients that ask for it by name. Most clients send
+    # */* as well, which would otherwise match.
+    for mime_type, quality in request.accept_mimetypes:
+        if mime_type == WEBP_MIMETYPE and quality > 0:
+            return 'WEBP'
+    return 'JPEG'
+
+def _variant_etag(image_hash, size, variant_format):
+    if size is None:
+        return image_hash
+    elif variant_format == 'JPEG':
+        return "{}@{}".format(image_hash, size)
+    else:
+        variant_ext, _ = VARIANT_FORMATS[variant_format]
+        return "{}@{}.{}".format(image_hash, size, variant_ext)
+
+def _immutable_not_modified(etag, size):
+    rsp = Response(status=304)
+    rsp.headers['ETag'] = etag
+    rsp.headers['Cache-control'] = IMMUTABLE_CACHE_CONTROL
+    if size is not None:
+        rsp.headers['Vary'] = 'Accept'
+    return rsp
 
 def _update_photo_dims(photo):
     path = get_photo_path(photo.id)
@@ -58,6 +78,16 @@ def _update_photo_dims(photo):
             photo.width = width
             photo.height = height
 
+def _update_photo_placeholder(photo):
+    path = get_photo_path(photo.id)
+    if os.path.exists(path):
+        photo.placeholder = make_placeholder(path)
+
+def _update_photo_exif(photo):
+    path = get_photo_path(photo.id)
+    if os.path.exists(path):
+        apply_exif(photo, read_exif(path))
+
 def _update_photo_type(photo):
     path = get_raw_photo_path(photo)
     if os.path.exists(path):
@@ -82,11 +112,15 @@ def image_meta(image_hash=None, cur_perms=None):
         count_until = request.args.getlist('countUntil[]')
         count_from = request.args.getlist('countFrom[]')
 
+        sort = request.args.get('order', 'created')
+        if sort not in SORT_KEYS:
+            return jsonify({'error': 'invalid ?order param'}), 400
+
         if len(count_until) > 0:
-            data['countsUntil'] = calc_counts_until([photo], count_until, session)
+            data['countsUntil'] = calc_counts_until([photo], count_until, session, sort=sort)
 
         if len(count_from) > 0:
-            data['countsFrom'] = calc_counts_from([photo], count_from, session)
+            data['countsFrom'] = calc_counts_from([photo], count_from, session, sort=sort)
 
         return jsonify(data)
 
@@ -151,7 +185,6 @@ def archive():
             if photo is None:
                 abort(404)
 
-            _ensure_photo_attrs(photo)
             filename = photo.id
             if photo.mime_type in CONTENT_TYPE_TO_EXTENSION:
                 filename += "." + CONTENT_TYPE_TO_EXTENSION[photo.mime_type]
@@ -202,19 +235,25 @@ def image(image_hash=None, cur_perms=None):
 
         fmt = request.args.get('format', 'normal')
 
+        # Variants are immutable, so a match can be answered without
+        # touching the database or the filesystem. The bare hash was also
+        # the ETag of HLS playlists, which change as formats complete, so
+        # it is only trusted once the photo is known not to be a video.
+        variant_format = None if size is None else _negotiate_variant_format()
+        etag = _variant_etag(image_hash, size, variant_format)
+        if size is not None and request.if_none_match.contains(etag):
+            return _immutable_not_modified(etag, size)
+
         with session_scope() as session:
             existing = session.query(Photo).get(image_hash)
             if existing is None:
                 return 'Not found', 404
 
             if existing.video:
-                if request.if_none_match.contains(image_hash):
-                    raise NotModified()
-
                 if fmt == 'raw':
                     path = get_photo_path("{}.tmp".format(image_hash), absolute=True)
                     r = send_file(path)
-                    r.headers['Cache-control'] = 'private, max-age=43200'
+                    r.headers['Cache-control'] = IMMUTABLE_CACHE_CONTROL
                     r.headers['ETag'] = image_hash
                     r.headers['Content-type'] = existing.mime_type
                     if existing.mime_type in CONTENT_TYPE_TO_EXTENSION:
@@ -226,6 +265,10 @@ def image(image_hash=None, cur_perms=None):
                     if len(vfs) == 0:
                         return 'No format available', 404
 
+                    hls_etag = '{}.m3u8.{}'.format(image_hash, len(vfs))
+                    if request.if_none_match.contains(hls_etag):
+                        raise NotModified()
+
                     hls = '''#EXTM3U
 #EXT-X-VERSION:3
 '''
@@ -235,31 +278,113 @@ def image(image_hash=None, cur_perms=None):
 
                     r = Response(hls)
                     r.headers['Content-type'] = M3U8_MIMETYPE
-                    r.headers['ETag'] = image_hash
+                    r.headers['ETag'] = hls_etag
                     r.headers['Cache-control'] = 'private, max-age=43200'
                     return r
             else:
 
                 orig_path = get_photo_path(image_hash, absolute=True)
-                photo_path = get_photo_path(image_hash, size=size, absolute=True)
+                photo_path = orig_path
 
                 if os.path.exists(orig_path):
 
-                    if not os.path.exists(photo_path):
-                        auto_resize(size, orig_path, photo_path)
-
-                    etag = image_hash if size is None else "{}@{}".format(image_hash, size)
-                    if request.if_none_match.contains(etag):
-                        raise NotModified()
+                    if size is None:
+                        if request.if_none_match.contains(etag):
+                            return _immutable_not_modified(etag, size)
+                        mime_type = existing.mime_type
+                    else:
+                        photo_path = ensure_variant(image_hash, size, variant_format)
+                        _, mime_type = VARIANT_FORMATS[variant_format]
 
                     rsp = send_file(photo_path)
-                    rsp.headers['Cache-control'] = 'private, max-age=43200'
+                    rsp.headers['Cache-control'] = IMMUTABLE_CACHE_CONTROL
                     rsp.headers['ETag'] = etag
-                    rsp.headers['Content-type'] = existing.mime_type
-                    if existing.mime_type in CONTENT_TYPE_TO_EXTENSION:
-                        rsp.headers['X-Extension'] = CONTENT_TYPE_TO_EXTENSION[existing.mime_type]
+                    rsp.headers['Content-type'] = mime_type
+                    if size is not None:
+                        rsp.headers['Vary'] = 'Accept'
+                    if mime_type in CONTENT_TYPE_TO_EXTENSION:
+                        rsp.headers['X-Extension'] = CONTENT_TYPE_TO_EXTENSION[mime_type]
                     return rsp
 
                 else:
                     return abort(404)
 
+
+@app.route('/image/thumbnails', methods=['POST'])
+def thumbnails():
+    '''Returns the thumbnails for many photos as one multipart/mixed
+    response. Each part is sent as soon as it is ready. Photos that do not
+    exist, are videos, or are not viewable are left out, and the client
+    should fall back to /image/<id> for them.'''
+
+    data = request.json
+    if not isinstance(data, dict) or \
+       not isinstance(data.get('ids'), list) or \
+       any(not isinstance(x, str) for x in data['ids']) or \
+       not isinstance(data.get('size'), int) or \
+       isinstance(data['size'], bool) or data['size'] <= 0:
+        abort(400)
+
+    if len(data['ids']) > MAX_THUMBNAIL_BATCH:
+        return jsonify({'error': 'at most {} ids allowed'.format(MAX_THUMBNAIL_BATCH)}), 400
+
+    size = round_size(data['size'])
+    variant_format = _negotiate_variant_format()
+    _, mime_type = VARIANT_FORMATS[variant_format]
+
+    # Nothing is required up front, so that album and photo shares can use
+    # this too. Each id is checked for itself.
+    cur_perms = perms.get_current_permissions()
+    which = [ x for x in set(data['ids'])
+              if photo_id_re.match(x) and
+                 (perms.debug or ViewPerm(photo_id=x) in cur_perms) ]
+
+    with session_scope() as session:
+        which = [ photo_id for photo_id, in session.query(Photo.id).filter(Photo.id.in_(which), Photo.video == False) ]
+
+    def make_variant(image_hash):
+        if not os.path.exists(get_photo_path(image_hash)):
+            return image_hash, None
+
+        # The variant may be evicted from the cache before it is read, in
+        # which case it is generated again
+        for _ in range(2):
+            photo_path = ensure_variant(image_hash, size, variant_format)
+            try:
+                with open(photo_path, 'rb') as f:
+                    return image_hash, f.read()
+            except FileNotFoundError:
+                continue
+
+        return image_hash, None
+
+    boundary = uuid.uuid4().hex
+
+    def make_parts():
+        futures = [ _thumbnail_batch_executor.submit(make_variant, image_hash)
+                    for image_hash in which ]
+        for future in as_completed(futures):
+            try:
+                image_hash, content = future.result()
+            except Exception as e:
+                print("Could not generate thumbnail", e)
+                continue
+
+            if content is None:
+                continue
+
+            headers = [ '--{}'.format(boundary),
+                        'Content-Type: {}'.format(mime_type),
+                        'Content-Length: {}'.format(len(content)),
+                        'Content-ID: <{}>'.format(image_hash),
+                        'ETag: {}'.format(_variant_etag(image_hash, size, variant_format)),
+                        '', '' ]
+            yield '\r\n'.join(headers).encode('ascii')
+            yield content
+            yield b'\r\n'
+
+        yield '--{}--\r\n'.format(boundary).encode('ascii')
+
+    rsp = Response(make_parts(), mimetype='multipart/mixed; boundary={}'.format(boundary))
+    rsp.headers['Vary'] = 'Accept'
+    return rsp
@@ -0,0 +1,164 @@
+from .app import app
+from .schema import session_scope, Photo, VideoFormat, \
+    PHOTO_PROCESSING, PHOTO_READY
+from .photos import _update_photo_dims, _update_photo_type, _update_photo_placeholder, \
+    _update_photo_exif
+from .video import DEFAULT_VIDEO_STREAMS
+from .util import get_raw_photo_path, get_photo_files
+from .ffmpeg import ffprobe
+from .thumbnails import thumbnail_queue
+
+from intrustd.tasks import schedule_command
+
+from concurrent.futures import ThreadPoolExecutor
+
+import threading
+import magic
+import os
+
+class ProcessingError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+def _process_photo(photo, session):
+    _update_photo_dims(photo)
+    _update_photo_type(photo)
+    _update_photo_placeholder(photo)
+    _update_photo_exif(photo)
+
+def _process_video(video, session):
+    video_path = get_raw_photo_path(video)
+
+    video.mime_type = magic.from_file(video_path, mime=True)
+
+    try:
+        info = ffprobe(video_path)
+    except Exception as e:
+        raise ProcessingError('ffmpeg {}'.format(str(e)))
+
+    # Make sure this has both a video and audio stream
+    vstreams = [ stream for stream in info['streams'] if stream['codec_type'] == 'video' ]
+    astreams = [ stream for stream in info['streams'] if stream['codec_type'] == 'audio' ]
+
+    if len(vstreams) == 0 or len(astreams) == 0:
+        raise ProcessingError('no streams')
+
+    # Only use first video stream
+    stream = vstreams[0]
+    width = int(stream['width'])
+    height = int(stream['height'])
+
+    video.width = width
+    video.height = height
+
+    vstreams = [vstream for vstream in DEFAULT_VIDEO_STREAMS
+                if vstream.can_encode(width, height) ]
+
+    if len(vstreams) == 0:
+        vstreams = [ DEFAULT_VIDEO_STREAMS[0] ]
+
+    fmts = []
+    for i, vstream in enumerate(vstreams):
+        fmt = VideoFormat(photo_id=video.id,
+                          width=vstream.width,
+                          height=vstream.height,
+                          command=vstream.command(video.id, width, height,
+                                                  preview=i==0),
+                          queued=None)
+        fmts.append(fmt)
+
+    fmts.sort(key=lambda v:v.width)
+
+    fmt = fmts[0]
+
+    task = schedule_command(fmt.command)
+    fmt.queued = task['id']
+
+    session.add_all(fmts)
+
+def _discard(photo_id):
+    '''Removes an upload that could not be processed, along with its
+    files, as the upload request did before processing moved here.'''
+
+    with session_scope() as session:
+        photo = session.query(Photo).get(photo_id)
+        if photo is None or photo.state != PHOTO_PROCESSING:
+            return
+
+        files = get_photo_files(photo)
+        session.delete(photo)
+
+    for path in files:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def process(photo_id):
+    try:
+        with session_scope() as session:
+            photo = session.query(Photo).get(photo_id)
+            if photo is None or photo.state != PHOTO_PROCESSING:
+                return
+
+            if photo.video:
+                _process_video(photo, session)
+            else:
+                _process_photo(photo, session)
+            photo.state = PHOTO_READY
+
+            is_photo = not photo.video
+
+    except Exception as e:
+        # Anything that goes wrong here would go wrong again on every
+        # restart, so only interrupted uploads stay processing
+        print("Could not process", photo_id,
+              e.message if isinstance(e, ProcessingError) else repr(e))
+        _discard(photo_id)
+        return
+
+    if is_photo:
+        thumbnail_queue.submit(photo_id)
+
+class Pipeline(object):
+    '''Extracts metadata from new uploads in the background, so that the
+    upload request can return as soon as the bytes are stored. Photos stay
+    in the processing state until this is done. Uploads that turn out to be
+    invalid (such as videos without streams, or corrupt images) are
+    deleted, so they never show up in listings, totals or the timeline.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self.queued = 0
+
+    def submit(self, photo_id):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=app.config['PIPELINE_WORKERS'])
+            self.queued += 1
+
+        future = self._executor.submit(process, photo_id)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self.queued -= 1
+
+        exc = future.exception()
+        if exc is not None:
+            # Only if the photo could not be discarded either. It stays
+            # processing, and is retried on next start.
+            print("Could not process upload", exc)
+
+    def resume(self):
+        '''Requeues uploads whose processing was interrupted'''
+
+        with session_scope() as session:
+            which = [ photo_id for photo_id, in
+                      session.query(Photo.id).filter(Photo.state == PHOTO_PROCESSING) ]
+
+        for photo_id in which:
+            self.submit(photo_id)
+
+pipeline = Pipeline()
@@ -0,0 +1,92 @@
+from PIL import Image
+
+import math
+
+# BlurHash (https://blurha.sh) of a photo, used by clients to paint
+# something before the thumbnail arrives. With 4x3 components the hash is
+# 28 characters.
+
+X_COMPONENTS = 4
+Y_COMPONENTS = 3
+
+# The hash only captures very low frequencies, so a tiny image is plenty
+SAMPLE_SIZE = 32
+
+BASE83_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+def _base83(value, length):
+    return ''.join(BASE83_CHARS[(value // (83 ** (length - i - 1))) % 83]
+                   for i in range(length))
+
+def _srgb_to_linear(value):
+    v = value / 255.0
+    if v <= 0.04045:
+        return v / 12.92
+    else:
+        return math.pow((v + 0.055) / 1.055, 2.4)
+
+def _linear_to_srgb(value):
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    else:
+        return int((1.055 * math.pow(v, 1 / 2.4) - 0.055) * 255 + 0.5)
+
+def _sign_pow(value, exp):
+    return math.copysign(math.pow(abs(value), exp), value)
+
+def blurhash(im, x_components=X_COMPONENTS, y_components=Y_COMPONENTS):
+    width, height = im.size
+    linear = [ tuple(_srgb_to_linear(c) for c in px) for px in im.getdata() ]
+
+    cos_x = [ [ math.cos(math.pi * i * x / width) for x in range(width) ]
+              for i in range(x_components) ]
+    cos_y = [ [ math.cos(math.pi * j * y / height) for y in range(height) ]
+              for j in range(y_components) ]
+
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                basis_y = cos_y[j][y]
+                for x in range(width):
+                    basis = cos_x[i][x] * basis_y
+                    pr, pg, pb = linear[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+
+            scale = (1 if i == 0 and j == 0 else 2) / float(width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+
+    if len(ac) > 0:
+        actual_max = max(abs(c) for factor in ac for c in factor)
+        quantised_max = max(0, min(82, int(math.floor(actual_max * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166.0
+        result += _base83(quantised_max, 1)
+    else:
+        max_value = 1.0
+        result += _base83(0, 1)
+
+    result += _base83((_linear_to_srgb(dc[0]) << 16) +
+                      (_linear_to_srgb(dc[1]) << 8) +
+                      _linear_to_srgb(dc[2]), 4)
+
+    for factor in ac:
+        r, g, b = (max(0, min(18, int(math.floor(_sign_pow(c / max_value, 0.5) * 9 + 9.5))))
+                   for c in factor)
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+
+    return result
+
+def make_placeholder(path):
+    with Image.open(path) as im:
+        im.draft('RGB', (SAMPLE_SIZE, SAMPLE_SIZE))
+        im.thumbnail((SAMPLE_SIZE, SAMPLE_SIZE))
+        return blurhash(im.convert('RGB'))
@@ -0,0 +1,283 @@
+from .schema import Session, Photo, PhotoTotal, SORT_KEYS, TOTAL_ORDER
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import attributes
+
+from datetime import datetime, timedelta
+
+import threading
+import bisect
+
+EPOCH = datetime(1970, 1, 1)
+
+# Bits of the id kept in each key. Photos taken in the same second only
+# need to differ in the first 16 hex digits of their hash.
+ID_BITS = 64
+ID_MASK = (1 << ID_BITS) - 1
+
+# Stands for a sort value that was not loaded when a photo changed
+UNKNOWN = object()
+
+# Number of ids looked up per query
+LOOKUP_CHUNK = 500
+
+def _rank_key(value, photo_id):
+    # Seconds, as stored by SQLite, then the id inverted so that ids sort
+    # descending inside an ascending key. A key is a ~100 bit int, 40
+    # bytes, plus 8 for its slot in the list.
+    seconds = (value - EPOCH) // timedelta(seconds=1)
+    inverted_id = int(photo_id[:ID_BITS // 4], 16) ^ ID_MASK
+    return (seconds << ID_BITS) | inverted_id
+
+def _read_token(session):
+    return session.query(PhotoTotal.total) \
+                  .filter(PhotoTotal.scope == TOTAL_ORDER).scalar()
+
+class RankIndex(object):
+    '''The keys of every photo, sorted in the reverse of
+    order_photos_default(), so that the number of photos before or after
+    any photo is a bisection away. Takes about 48 bytes per photo, so
+    around 50MB for both sort keys of a 500k photo library.
+
+    The index is valid for one value of the 'order' PhotoTotal, which
+    triggers bump whenever a photo is added, removed or has a sort column
+    changed. Commits by this process are applied as they happen, and
+    advance the token to the value they committed. Any other change, such
+    as photo-backfill rewriting taken_on, leaves the database ahead of the
+    index, and causes a rebuild. Edits that don't touch the sort columns
+    leave the index alone.'''
+
+    def __init__(self, sort):
+        self.sort = sort
+        self._lock = threading.Lock()
+        self._keys = None
+        self._token = None
+        self._pending = set()
+
+    def _column(self):
+        return getattr(Photo, SORT_KEYS[self.sort])
+
+    def _rebuild(self, session, token):
+        keys = [ _rank_key(value, photo_id)
+                 for photo_id, value in session.query(Photo.id, self._column())
+                 if value is not None ]
+        keys.sort()
+
+        self._keys = keys
+        self._pending.clear()
+
+        # A commit between the two reads of the token may or may not be in
+        # keys, and its apply() can't tell. The index is then only used
+        # for this call, and rebuilt on the next.
+        if _read_token(session) == token:
+            self._token = token
+        else:
+            self._token = None
+
+    def _insert_pending(self, session):
+        which = list(self._pending)
+        self._pending.clear()
+
+        for i in range(0, len(which), LOOKUP_CHUNK):
+            chunk = which[i:i + LOOKUP_CHUNK]
+            for photo_id, value in session.query(Photo.id, self._column()) \
+                                          .filter(Photo.id.in_(chunk)):
+                if value is None:
+                    continue
+
+                # Already there if a rebuild picked it up
+                key = _rank_key(value, photo_id)
+                i = bisect.bisect_left(self._keys, key)
+                if i == len(self._keys) or self._keys[i] != key:
+                    self._keys.insert(i, key)
+
+    def _sync(self, session):
+        token = _read_token(session)
+
+        if self._keys is None or token != self._token:
+            self._rebuild(session, token)
+        elif len(self._pending) > 0:
+            self._insert_pending(session)
+
+    def _invalidate(self):
+        self._keys = None
+        self._token = None
+        self._pending.clear()
+
+    def apply(self, changes, token_before, token_after):
+        '''Applies changes committed by this process, which moved the
+        token from token_before to token_after. Each change is a photo id,
+        the sort value it had, and whether it still exists.'''
+
+        with self._lock:
+            if self._keys is None:
+                return
+
+            if self._token != token_before:
+                self._invalidate()
+                return
+
+            for photo_id, old_value, present in changes:
+                if old_value is UNKNOWN:
+                    self._invalidate()
+                    return
+                elif photo_id in self._pending:
+                    self._pending.discard(photo_id)
+                elif old_value is not None:
+                    key = _rank_key(old_value, photo_id)
+                    i = bisect.bisect_left(self._keys, key)
+                    if i < len(self._keys) and self._keys[i] == key:
+                        del self._keys[i]
+                    else:
+                        self._invalidate()
+                        return
+
+                if present:
+                    self._pending.add(photo_id)
+
+            self._token = token_after
+
+    def _reference_keys(self, references, session):
+        keys = {}
+        for reference in references:
+            if reference == 'beginning' or reference == 'end':
+                keys[reference] = None
+            else:
+                ref_img = session.query(Photo).get(reference)
+                if ref_img is None:
+                    continue
+
+                value = getattr(ref_img, SORT_KEYS[self.sort])
+                keys[reference] = UNKNOWN if value is None else _rank_key(value, ref_img.id)
+
+        return keys
+
+    def counts_until(self, anchor, references, session):
+        '''For each reference, the number of photos after anchor and before
+        the reference, or after anchor if the reference is 'beginning' or
+        'end'.'''
+
+        anchor_value = getattr(anchor, SORT_KEYS[self.sort])
+        ref_keys = self._reference_keys(references, session)
+
+        with self._lock:
+            self._sync(session)
+
+            res = {}
+            for reference, ref_key in ref_keys.items():
+                if anchor_value is None or ref_key is UNKNOWN:
+                    # Nothing compares with NULL
+                    res[reference] = 0
+                    continue
+
+                after_anchor = bisect.bisect_left(self._keys, _rank_key(anchor_value, anchor.id))
+                if ref_key is None:
+                    res[reference] = after_anchor
+                else:
+                    res[reference] = max(0, after_anchor - bisect.bisect_right(self._keys, ref_key))
+
+            return res
+
+    def counts_from(self, anchor, references, session):
+        '''For each reference, the number of photos before anchor and after
+        the reference, or before anchor if the reference is 'beginning' or
+        'end'.'''
+
+        anchor_value = getattr(anchor, SORT_KEYS[self.sort])
+        ref_keys = self._reference_keys(references, session)
+
+        with self._lock:
+            self._sync(session)
+
+            res = {}
+            for reference, ref_key in ref_keys.items():
+                if anchor_value is None or ref_key is UNKNOWN:
+                    res[reference] = 0
+                    continue
+
+                not_before_anchor = bisect.bisect_right(self._keys, _rank_key(anchor_value, anchor.id))
+                if ref_key is None:
+                    res[reference] = len(self._keys) - not_before_anchor
+                else:
+                    res[reference] = max(0, bisect.bisect_left(self._keys, ref_key) - not_before_anchor)
+
+            return res
+
+rank_indices = { sort: RankIndex(sort) for sort in SORT_KEYS }
+
+def calc_counts_until(photos, counts_until, session, sort='created'):
+    if len(photos) == 0:
+        return {}
+
+    return rank_indices[sort].counts_until(photos[-1], counts_until, session)
+
+def calc_counts_from(photos, counts_from, session, sort='created'):
+    if len(photos) == 0:
+        return {}
+
+    return rank_indices[sort].counts_from(photos[0], counts_from, session)
+
+def _loaded_value(photo, name):
+    value = inspect(photo).attrs[name].loaded_value
+    return UNKNOWN if value is attributes.NO_VALUE else value
+
+@event.listens_for(Session, 'after_flush')
+def _track_rank_changes(session, flush_context):
+    # Still sees the pre-flush state of every object
+    changes = session.info.setdefault('rank_changes', [])
+    flushed = len(changes)
+
+    for photo in session.new:
+        if isinstance(photo, Photo):
+            changes.append((photo.id, { sort: None for sort in SORT_KEYS }, True))
+
+    for photo in session.deleted:
+        if isinstance(photo, Photo):
+            changes.append((photo.id, { sort: _loaded_value(photo, name)
+                                        for sort, name in SORT_KEYS.items() }, False))
+
+    for photo in session.dirty:
+        if not isinstance(photo, Photo):
+            continue
+
+        histories = { sort: attributes.get_history(photo, name)
+                      for sort, name in SORT_KEYS.items() }
+        if not any(history.has_changes() for history in histories.values()):
+            continue
+
+        old_values = {}
+        for sort, history in histories.items():
+            if history.deleted:
+                old_values[sort] = history.deleted[0]
+            elif history.unchanged:
+                old_values[sort] = history.unchanged[0]
+            else:
+                old_values[sort] = UNKNOWN
+
+        changes.append((photo.id, old_values, True))
+
+    flushed = len(changes) - flushed
+    if flushed > 0:
+        # This transaction holds the write lock now, so nobody else can
+        # move the token until it commits. The triggers bumped it once per
+        # change, which gives the token the index must be at to apply them.
+        token_after = _read_token(session)
+        token_before, _ = session.info.get('rank_tokens', (token_after - flushed, None))
+        session.info['rank_tokens'] = (token_before, token_after)
+
+@event.listens_for(Session, 'after_commit')
+def _apply_rank_changes(session):
+    changes = session.info.pop('rank_changes', [])
+    tokens = session.info.pop('rank_tokens', None)
+    if tokens is None:
+        return
+
+    for sort, index in rank_indices.items():
+        index.apply([ (photo_id, old_values[sort], present)
+                      for photo_id, old_values, present in changes ],
+                    *tokens)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rank_changes(session):
+    session.info.pop('rank_changes', None)
+    session.info.pop('rank_tokens', None)
@@ -0,0 +1,264 @@
+from .app import app, no_store
+from .perms import perms, UploadPerm
+from .upload import UPLOAD_HANDLERS, handle_upload
+from .util import HashingSpool, SPOOL_CHUNK_SIZE, atomic_output
+
+from flask import jsonify, request, abort
+
+from contextlib import contextmanager
+
+import threading
+import time
+import json
+import uuid
+import re
+import os
+
+session_id_re = re.compile('^[a-f0-9]{32}$')
+session_file_re = re.compile(r'^([a-f0-9]{32})\.(resumable|json)$')
+
+class UploadSession(object):
+    '''An upload that is sent in chunks over several requests, so that a
+    dropped connection only loses the chunk in flight. The data is kept in
+    UPLOAD_FOLDER as <id>.resumable, with its content type and expected
+    size in <id>.json. Sessions idle for UPLOAD_SESSION_TIMEOUT are
+    removed.'''
+
+    def __init__(self, session_id, content_type, size, spool):
+        self.id = session_id
+        self.content_type = content_type
+        self.size = size
+        self.spool = spool
+        self.lock = threading.Lock()
+        self.active = time.time()
+
+        # Set once the session is finished or deleted. Requests that were
+        # waiting on the lock must not touch the spool after that.
+        self.removed = False
+
+    @staticmethod
+    def _paths(session_id):
+        base = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+        return '{}.resumable'.format(base), '{}.json'.format(base)
+
+    @classmethod
+    def create(cls, content_type, size):
+        session_id = uuid.uuid4().hex
+        data_path, info_path = cls._paths(session_id)
+
+        with atomic_output(info_path) as tmp_path:
+            with open(tmp_path, 'wt') as f:
+                json.dump({ 'type': content_type, 'size': size }, f)
+
+        return cls(session_id, content_type, size, HashingSpool(path=data_path))
+
+    @classmethod
+    def load(cls, session_id):
+        data_path, info_path = cls._paths(session_id)
+        try:
+            with open(info_path, 'rt') as f:
+                info = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if not os.path.exists(data_path):
+            return None
+
+        return cls(session_id, info['type'], info['size'], HashingSpool(path=data_path))
+
+    def remove(self):
+        self.removed = True
+        self.spool.discard()
+
+        _, info_path = self._paths(self.id)
+        try:
+            os.unlink(info_path)
+        except FileNotFoundError:
+            pass
+
+    def to_json(self):
+        return { 'id': self.id,
+                 'type': self.content_type,
+                 'offset': self.spool.length,
+                 'size': self.size }
+
+_sessions_lock = threading.Lock()
+_sessions = {}
+
+def _get_session(session_id):
+    if not session_id_re.match(session_id):
+        abort(404)
+
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+        if session is None:
+            # Sessions outlive the server, so look for one left on disk
+            session = UploadSession.load(session_id)
+            if session is None:
+                abort(404)
+            _sessions[session_id] = session
+
+        session.active = time.time()
+        return session
+
+@contextmanager
+def _lock_session(session):
+    '''Holds the lock of session. Aborts if the session was finished or
+    deleted while waiting for it.'''
+
+    with session.lock:
+        if session.removed:
+            abort(404)
+        yield
+
+def _forget_session(session):
+    with _sessions_lock:
+        _sessions.pop(session.id, None)
+    session.remove()
+
+def expire_sessions():
+    '''Removes sessions that have been idle for UPLOAD_SESSION_TIMEOUT,
+    including those left on disk by an earlier run of the server'''
+
+    cutoff = time.time() - app.config['UPLOAD_SESSION_TIMEOUT']
+
+    with _sessions_lock:
+        idle = [ session for session in _sessions.values() if session.active < cutoff ]
+
+    for session in idle:
+        with session.lock:
+            if session.removed or session.active >= cutoff:
+                continue
+
+            _forget_session(session)
+
+    stale = {}
+    with os.scandir(app.config['UPLOAD_FOLDER']) as entries:
+        for entry in entries:
+            match = session_file_re.match(entry.name)
+            if match is None:
+                continue
+
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+
+            session_id = match.group(1)
+            stale[session_id] = max(stale.get(session_id, 0), mtime)
+
+    for session_id, mtime in stale.items():
+        if mtime >= cutoff:
+            continue
+
+        # Holding the lock keeps _get_session() from loading it meanwhile
+        with _sessions_lock:
+            if session_id in _sessions:
+                continue
+
+            for path in UploadSession._paths(session_id):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+def _sweep_sessions():
+    while True:
+        time.sleep(app.config['UPLOAD_SESSION_SWEEP_INTERVAL'])
+        try:
+            expire_sessions()
+        except Exception as e:
+            print("Could not expire upload sessions", e)
+
+def start_session_sweeper():
+    threading.Thread(target=_sweep_sessions, daemon=True).start()
+
+@app.route('/upload', methods=['POST'])
+@perms.require(UploadPerm)
+@no_store
+def create_upload(cur_perms=None):
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'error': 'expected an object'}), 400
+
+    content_type = data.get('type')
+    if content_type not in UPLOAD_HANDLERS:
+        return jsonify({'error': '{} is not an accepted content type'.format(content_type)}), 415
+
+    size = data.get('size')
+    if size is not None and (not isinstance(size, int) or size < 0):
+        return jsonify({'error': 'size must be a non-negative integer'}), 400
+
+    session = UploadSession.create(content_type, size)
+    with _sessions_lock:
+        _sessions[session.id] = session
+
+    return jsonify(session.to_json()), 201
+
+@app.route('/upload/<session_id>', methods=['GET', 'PUT', 'DELETE'])
+@perms.require(UploadPerm)
+@no_store
+def upload_session(session_id=None, cur_perms=None):
+    session = _get_session(session_id)
+
+    with _lock_session(session):
+        if request.method == 'GET':
+            return jsonify(session.to_json())
+
+        elif request.method == 'PUT':
+            try:
+                offset = int(request.args.get('offset', ''))
+            except ValueError:
+                return jsonify({'error': 'expected ?offset'}), 400
+
+            # Only appends are allowed. A client that lost track of what
+            # was committed gets the current offset back.
+            if offset != session.spool.length:
+                return jsonify(session.to_json()), 409
+
+            # Checked up front, so that a rejected chunk leaves nothing behind
+            if session.size is not None:
+                if request.content_length is None:
+                    return jsonify({'error': 'Content-Length required'}), 411
+
+                if offset + request.content_length > session.size:
+                    return jsonify({'error': 'upload larger than declared size'}), 400
+
+            while True:
+                chunk = request.stream.read(SPOOL_CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+
+                session.spool.write(chunk)
+
+            session.spool.flush()
+
+            return jsonify(session.to_json())
+
+        else:
+            _forget_session(session)
+            return jsonify({})
+
+@app.route('/upload/<session_id>/finish', methods=['POST'])
+@perms.require(UploadPerm)
+@no_store
+def finish_upload(session_id=None, cur_perms=None):
+    session = _get_session(session_id)
+
+    with _lock_session(session):
+        if session.size is not None and session.spool.length != session.size:
+            return jsonify({'error': 'upload incomplete',
+                            'offset': session.spool.length,
+                            'size': session.size}), 400
+
+        session.spool.seek(0, os.SEEK_SET)
+        try:
+            rsp = handle_upload(UPLOAD_HANDLERS[session.content_type], session.spool)
+        except Exception:
+            # Something like a locked database. Keep the data, so that the
+            # client can finish again.
+            session.spool = HashingSpool(path=session.spool.path)
+            raise
+
+        _forget_session(session)
+        return rsp
@@ -1,19 +1,36 @@
 from sqlalchemy.ext.orderinglist import ordering_list
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, \
-    ForeignKey, func, create_engine, or_, and_, event
+from sqlalchemy import Column, Integer, Float, String, DateTime, Boolean, \
+    ForeignKey, Table, func, create_engine, or_, event
 from sqlalchemy.orm import relationship, sessionmaker, backref
+from sqlalchemy.dialects.sqlite import DATETIME
 from sqlalchemy.ext.declarative import declarative_base
 
 from contextlib import contextmanager
 from datetime import datetime
 
-from intrustd.tasks import get_scheduled_command_status
+import os
 
-from .util import get_photo_dir, datetime_json, datetime_sql
+from .util import get_photo_dir, datetime_json, datetime_sql, VARIANT_DIR
+from .fragments import photo_fragments
 
-LATEST_VERSION = 7
+LATEST_VERSION = 19
 Base = declarative_base()
 
+# Photo.state. New uploads are processing until their metadata has been
+# extracted in the background. Uploads that can't be processed are
+# deleted.
+PHOTO_PROCESSING = 'processing'
+PHOTO_READY = 'ready'
+
+# Stored the same way as CURRENT_TIMESTAMP, so that values written from
+# python compare correctly against those from func.now() and datetime_sql()
+SecondsDateTime = DATETIME(storage_format='%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d',
+                           regexp=r'(\d+)-(\d+)-(\d+) (\d+):(\d+):(\d+)')
+
+# Keys photos can be ordered and paged by, and the column for each
+SORT_KEYS = { 'created': 'created_on',
+              'taken': 'taken_on' }
+
 class Photo(Base):
     __tablename__ = 'photo'
 
@@ -29,16 +46,50 @@ class Photo(Base):
 
     mime_type = Column(String)
 
+    placeholder = Column(String, nullable=True)
+
+    state = Column(String, default=PHOTO_READY)
+
+    # From EXIF, in UTC if the camera recorded its offset and in its local
+    # time otherwise. taken_on falls back to the upload time.
+    taken_on = Column(SecondsDateTime, default=func.now())
+    orientation = Column(Integer, nullable=True)
+    camera = Column(String, nullable=True)
+    has_gps = Column(Boolean, nullable=True)
+
     tags = relationship('PhotoTag', cascade='delete,delete-orphan')
     video_formats = relationship('VideoFormat', cascade='delete,delete-orphan')
 
+    def json_key(self):
+        '''Everything build_json() depends on'''
+
+        formats = ()
+        if self.video:
+            formats = tuple((vf.width, vf.height, vf.is_complete, vf.progress)
+                            for vf in self.video_formats)
+
+        return (self.modified_on, self.created_on, self.taken_on, self.description,
+                self.width, self.height, self.placeholder, self.state, self.video,
+                formats)
+
     def to_json(self):
+        data, _ = photo_fragments.get(self)
+        return dict(data)
+
+    def to_json_bytes(self):
+        _, encoded = photo_fragments.get(self)
+        return encoded
+
+    def build_json(self):
         r = {'id': self.id,
              'description': self.description or '',
              'created': datetime_json(self.created_on),
              'modified': datetime_json(self.modified_on),
+             'taken': datetime_json(self.taken_on) if self.taken_on is not None else None,
              'width': self.width,
              'height': self.height,
+             'placeholder': self.placeholder,
+             'state': self.state,
              'type': 'video' if self.video else 'photo'}
 
         if self.video:
@@ -49,16 +100,8 @@ class Photo(Base):
                 for vf in self.video_formats:
                     if vf.is_complete:
                         complete += vf.width
-                    elif vf.queued is not None:
-                        try:
-                            sts = get_scheduled_command_status(vf.queued)
-                        except KeyError:
-                            continue
-
-                        if 'progress' in sts and isinstance(sts['progress'], dict) and \
-                           'data' in sts['progress'] and isinstance(sts['progress']['data'], dict):
-                            pr = sts['progress']['data']
-                            complete += vf.width * float(pr.get('cur_us', 0))/float(pr.get('total_us', 1))
+                    elif vf.progress is not None:
+                        complete += vf.width * vf.progress
 
                 r['progress'] = { 'total': total, 'complete': complete }
 
@@ -85,6 +128,9 @@ class VideoFormat(Base):
     command = Column(String, nullable=True)
     queued = Column(String, nullable=True)
 
+    # Fraction of the transcode done, written by transcode-video
+    progress = Column(Float, nullable=True)
+
     def to_photo_json(self):
         return { 'width':  self.width,
                  'height': self.height }
@@ -166,6 +212,70 @@ class AlbumItem(Base):
 
         return data
 
+# PhotoTotal.scope of the whole library, and prefixes of the per-tag and
+# per-album totals
+TOTAL_LIBRARY = ''
+TOTAL_TAG = 'tag:'
+TOTAL_ALBUM = 'album:'
+
+# PhotoTotal.scope whose total counts every change to the others, or to a
+# description
+TOTAL_CHANGES = 'changes'
+
+# PhotoTotal.scope whose total counts every photo inserted or deleted, and
+# every change to a SORT_KEYS column. Bumped once per photo row.
+TOTAL_ORDER = 'order'
+
+class PhotoTotal(Base):
+    __tablename__ = 'photo_total'
+
+    # Kept up to date by triggers, see do_migrate()
+    scope = Column(String, primary_key=True)
+    total = Column(Integer)
+
+class PhotoSearchDoc(Base):
+    __tablename__ = 'photo_search_doc'
+
+    # The rowid of the photo in photo_search
+    docid = Column(Integer, primary_key=True)
+    photo_id = Column(String(64), ForeignKey('photo.id'), unique=True)
+
+# Full-text index of the description and tags of every photo. An FTS5
+# table, kept in sync by triggers, see do_migrate()
+photo_search = Table('photo_search', Base.metadata,
+                     Column('rowid', Integer, primary_key=True),
+                     Column('description', String),
+                     Column('tags', String))
+
+class PhotoTimeline(Base):
+    __tablename__ = 'photo_timeline'
+
+    # The number of photos of scope (as in PhotoTotal) on each day, by the
+    # column of sort. Kept up to date by triggers, see do_migrate()
+    scope = Column(String, primary_key=True)
+    sort = Column(String, primary_key=True)
+    day = Column(String, primary_key=True)
+    total = Column(Integer)
+
+# ChangeLog.kind
+CHANGE_PHOTO = 'photo'
+CHANGE_TAG = 'tag'
+CHANGE_ALBUM = 'album'
+CHANGE_ALBUM_ITEM = 'album_item'
+
+class ChangeLog(Base):
+    __tablename__ = 'change_log'
+
+    # Written by triggers, see do_migrate(). key is the id of the photo,
+    # album or album item, or the tag name, and parent is the photo of a
+    # tag or the album of an album item. Only the latest entry for each
+    # (kind, key, parent) is kept.
+    seq = Column(Integer, primary_key=True)
+    kind = Column(String)
+    key = Column(String)
+    parent = Column(String, nullable=True)
+    deleted = Column(Boolean)
+
 class Version(Base):
     __tablename__ = 'version'
 
@@ -257,6 +367,414 @@ def do_migrate():
               CREATE UNIQUE INDEX album_item_photo_index ON album_item ( album_id, photo_id )
             ''')
 
+        if version <= 7:
+            connection.execute('''
+               ALTER TABLE photo ADD COLUMN placeholder VARCHAR
+            ''')
+
+        if version <= 8:
+            connection.execute('''
+               ALTER TABLE photo ADD COLUMN state VARCHAR NOT NULL DEFAULT 'ready'
+            ''')
+
+        if version <= 9:
+            connection.execute('''
+               ALTER TABLE photo ADD COLUMN taken_on TIMESTAMP
+            ''')
+            connection.execute('''
+               ALTER TABLE photo ADD COLUMN orientation INTEGER
+            ''')
+            connection.execute('''
+               ALTER TABLE photo ADD COLUMN camera VARCHAR
+            ''')
+            connection.execute('''
+               ALTER TABLE photo ADD COLUMN has_gps BOOLEAN
+            ''')
+            # Until photo-backfill reads the EXIF data
+            connection.execute('''
+               UPDATE photo SET taken_on = created_on
+            ''')
+            connection.execute('''
+               CREATE INDEX photo_taken ON photo (taken_on)
+            ''')
+
+        if version <= 10:
+            # Match order_photos_default(), so that paging is an index
+            # range scan that stops at the limit
+            connection.execute('''
+               CREATE INDEX photo_created_order ON photo (created_on DESC, id ASC)
+            ''')
+            connection.execute('''
+               CREATE INDEX photo_taken_order ON photo (taken_on DESC, id ASC)
+            ''')
+            connection.execute('''
+               DROP INDEX photo_taken
+            ''')
+
+        if version <= 11:
+            connection.execute('''
+               CREATE TABLE photo_total ( scope VARCHAR NOT NULL PRIMARY KEY,
+                                          total INTEGER NOT NULL )
+            ''')
+            connection.execute('''
+               INSERT INTO photo_total(scope, total)
+                 SELECT '', count(*) FROM photo
+            ''')
+            connection.execute('''
+               INSERT INTO photo_total(scope, total) VALUES ('changes', 0)
+            ''')
+            connection.execute('''
+               INSERT INTO photo_total(scope, total)
+                 SELECT 'tag:' || tag, count(*) FROM photo_tag GROUP BY tag
+            ''')
+            connection.execute('''
+               INSERT INTO photo_total(scope, total)
+                 SELECT 'album:' || album_id, count(*) FROM album_item
+                 WHERE photo_id IS NOT NULL GROUP BY album_id
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_total_photo_insert AFTER INSERT ON photo
+               BEGIN
+                 UPDATE photo_total SET total = total + 1 WHERE scope IN ('', 'changes');
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_total_photo_delete AFTER DELETE ON photo
+               BEGIN
+                 UPDATE photo_total SET total = total - 1 WHERE scope = '';
+                 UPDATE photo_total SET total = total + 1 WHERE scope = 'changes';
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_total_description_update AFTER UPDATE OF description ON photo
+               WHEN OLD.description IS NOT NEW.description
+               BEGIN
+                 UPDATE photo_total SET total = total + 1 WHERE scope = 'changes';
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_total_tag_insert AFTER INSERT ON photo_tag
+               BEGIN
+                 INSERT OR IGNORE INTO photo_total(scope, total) VALUES ('tag:' || NEW.tag, 0);
+                 UPDATE photo_total SET total = total + 1 WHERE scope IN ('tag:' || NEW.tag, 'changes');
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_total_tag_delete AFTER DELETE ON photo_tag
+               BEGIN
+                 UPDATE photo_total SET total = total - 1 WHERE scope = 'tag:' || OLD.tag;
+                 UPDATE photo_total SET total = total + 1 WHERE scope = 'changes';
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_total_album_item_insert AFTER INSERT ON album_item
+               WHEN NEW.photo_id IS NOT NULL
+               BEGIN
+                 INSERT OR IGNORE INTO photo_total(scope, total) VALUES ('album:' || NEW.album_id, 0);
+                 UPDATE photo_total SET total = total + 1 WHERE scope IN ('album:' || NEW.album_id, 'changes');
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_total_album_item_delete AFTER DELETE ON album_item
+               WHEN OLD.photo_id IS NOT NULL
+               BEGIN
+                 UPDATE photo_total SET total = total - 1 WHERE scope = 'album:' || OLD.album_id;
+                 UPDATE photo_total SET total = total + 1 WHERE scope = 'changes';
+               END
+            ''')
+
+        if version <= 12:
+            connection.execute('''
+               CREATE TABLE photo_search_doc ( docid INTEGER PRIMARY KEY,
+                                               photo_id CHAR(64) NOT NULL UNIQUE )
+            ''')
+            connection.execute('''
+               CREATE VIRTUAL TABLE photo_search USING fts5(description, tags, prefix='2 3')
+            ''')
+            connection.execute('''
+               INSERT INTO photo_search_doc(photo_id) SELECT id FROM photo
+            ''')
+            connection.execute('''
+               INSERT INTO photo_search(rowid, description, tags)
+                 SELECT photo_search_doc.docid, photo.description,
+                        coalesce((SELECT group_concat(tag, ' ') FROM photo_tag
+                                  WHERE photo_tag.photo_id = photo.id), '')
+                 FROM photo JOIN photo_search_doc ON photo_search_doc.photo_id = photo.id
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_search_photo_insert AFTER INSERT ON photo
+               BEGIN
+                 INSERT INTO photo_search_doc(photo_id) VALUES (NEW.id);
+                 INSERT INTO photo_search(rowid, description, tags)
+                   SELECT docid, NEW.description, '' FROM photo_search_doc WHERE photo_id = NEW.id;
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_search_photo_delete AFTER DELETE ON photo
+               BEGIN
+                 DELETE FROM photo_search
+                   WHERE rowid = (SELECT docid FROM photo_search_doc WHERE photo_id = OLD.id);
+                 DELETE FROM photo_search_doc WHERE photo_id = OLD.id;
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_search_description_update AFTER UPDATE OF description ON photo
+               WHEN OLD.description IS NOT NEW.description
+               BEGIN
+                 UPDATE photo_search SET description = NEW.description
+                   WHERE rowid = (SELECT docid FROM photo_search_doc WHERE photo_id = NEW.id);
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_search_tag_insert AFTER INSERT ON photo_tag
+               BEGIN
+                 UPDATE photo_search
+                   SET tags = (SELECT group_concat(tag, ' ') FROM photo_tag WHERE photo_id = NEW.photo_id)
+                   WHERE rowid = (SELECT docid FROM photo_search_doc WHERE photo_id = NEW.photo_id);
+               END
+            ''')
+            connection.execute('''
+               CREATE TRIGGER photo_search_tag_delete AFTER DELETE ON photo_tag
+               BEGIN
+                 UPDATE photo_search
+                   SET tags = coalesce((SELECT group_concat(tag, ' ') FROM photo_tag
+                                        WHERE photo_id = OLD.photo_id), '')
+                   WHERE rowid = (SELECT docid FROM photo_search_doc WHERE photo_id = OLD.photo_id);
+               END
+            ''')
+
+        if version <= 13:
+            connection.execute('''
+               ALTER TABLE video_format ADD COLUMN progress REAL
+            ''')
+
+        if version <= 14:
+            # The tag and album scopes of every photo, as used by photo_total
+            connection.execute('''
+               CREATE VIEW photo_scope AS
+                 SELECT photo_id, 'tag:' || tag AS scope FROM photo_tag
+                 UNION ALL
+                 SELECT photo_id, 'album:' || album_id AS scope FROM album_item
+                 WHERE photo_id IS NOT NULL
+            ''')
+            connection.execute('''
+               CREATE TABLE photo_timeline ( scope VARCHAR NOT NULL,
+                                             sort VARCHAR NOT NULL,
+                                             day VARCHAR NOT NULL,
+                                             total INTEGER NOT NULL,
+                                             PRIMARY KEY (scope, sort, day) )
+            ''')
+
+            for sort, column in (('created', 'created_on'), ('taken', 'taken_on')):
+                names = { 'sort': sort, 'column': column }
+
+                connection.execute('''
+                   INSERT INTO photo_timeline(scope, sort, day, total)
+                     SELECT '', '{sort}', date({column}), count(*) FROM photo
+                     WHERE {column} IS NOT NULL
+                     GROUP BY date({column})
+                '''.format(**names))
+                connection.execute('''
+                   INSERT INTO photo_timeline(scope, sort, day, total)
+                     SELECT photo_scope.scope, '{sort}', date(photo.{column}), count(*)
+                     FROM photo_scope JOIN photo ON photo.id = photo_scope.photo_id
+                     WHERE photo.{column} IS NOT NULL
+                     GROUP BY photo_scope.scope, date(photo.{column})
+                '''.format(**names))
+
+                connection.execute('''
+                   CREATE TRIGGER photo_timeline_{sort}_insert AFTER INSERT ON photo
+                   BEGIN
+                     INSERT OR IGNORE INTO photo_timeline(scope, sort, day, total)
+                       SELECT '', '{sort}', date(NEW.{column}), 0 WHERE NEW.{column} IS NOT NULL;
+                     UPDATE photo_timeline SET total = total + 1
+                       WHERE scope = '' AND sort = '{sort}' AND day = date(NEW.{column});
+                   END
+                '''.format(**names))
+                # Tags and album items may be deleted before or after the
+                # photo, so both sides remove what is still there
+                connection.execute('''
+                   CREATE TRIGGER photo_timeline_{sort}_delete AFTER DELETE ON photo
+                   BEGIN
+                     UPDATE photo_timeline SET total = total - 1
+                       WHERE sort = '{sort}' AND day = date(OLD.{column}) AND
+                             (scope = '' OR
+                              scope IN (SELECT scope FROM photo_scope WHERE photo_id = OLD.id));
+                   END
+                '''.format(**names))
+                connection.execute('''
+                   CREATE TRIGGER photo_timeline_{sort}_update AFTER UPDATE OF {column} ON photo
+                   WHEN OLD.{column} IS NOT NEW.{column}
+                   BEGIN
+                     UPDATE photo_timeline SET total = total - 1
+                       WHERE sort = '{sort}' AND day = date(OLD.{column}) AND
+                             (scope = '' OR
+                              scope IN (SELECT scope FROM photo_scope WHERE photo_id = OLD.id));
+                     INSERT OR IGNORE INTO photo_timeline(scope, sort, day, total)
+                       SELECT scope, '{sort}', date(NEW.{column}), 0
+                       FROM (SELECT '' AS scope
+                             UNION ALL
+                             SELECT scope FROM photo_scope WHERE photo_id = NEW.id)
+                       WHERE NEW.{column} IS NOT NULL;
+                     UPDATE photo_timeline SET total = total + 1
+                       WHERE sort = '{sort}' AND day = date(NEW.{column}) AND
+                             (scope = '' OR
+                              scope IN (SELECT scope FROM photo_scope WHERE photo_id = NEW.id));
+                   END
+                '''.format(**names))
+
+                for table, scope, condition in (('photo_tag', "'tag:' || {row}.tag", '1'),
+                                                ('album_item', "'album:' || {row}.album_id",
+                                                 '{row}.photo_id IS NOT NULL')):
+                    connection.execute('''
+                       CREATE TRIGGER photo_timeline_{sort}_{table}_insert AFTER INSERT ON {table}
+                       WHEN {condition}
+                       BEGIN
+                         INSERT OR IGNORE INTO photo_timeline(scope, sort, day, total)
+                           SELECT {scope}, '{sort}', date({column}), 0 FROM photo
+                           WHERE id = NEW.photo_id AND {column} IS NOT NULL;
+                         UPDATE photo_timeline SET total = total + 1
+                           WHERE scope = {scope} AND sort = '{sort}' AND
+                                 day = (SELECT date({column}) FROM photo WHERE id = NEW.photo_id);
+                       END
+                    '''.format(table=table, scope=scope.format(row='NEW'),
+                               condition=condition.format(row='NEW'), **names))
+                    connection.execute('''
+                       CREATE TRIGGER photo_timeline_{sort}_{table}_delete AFTER DELETE ON {table}
+                       WHEN {condition}
+                       BEGIN
+                         UPDATE photo_timeline SET total = total - 1
+                           WHERE scope = {scope} AND sort = '{sort}' AND
+                                 day = (SELECT date({column}) FROM photo WHERE id = OLD.photo_id);
+                       END
+                    '''.format(table=table, scope=scope.format(row='OLD'),
+                               condition=condition.format(row='OLD'), **names))
+
+        if version <= 15:
+            connection.execute('''
+               CREATE TABLE change_log ( seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                         kind VARCHAR NOT NULL,
+                                         key VARCHAR NOT NULL,
+                                         parent VARCHAR,
+                                         deleted BOOLEAN NOT NULL )
+            ''')
+
+            # (table, kind, key, parent) of each logged table. {row} is NEW
+            # or OLD.
+            logged = (('photo', 'photo', '{row}.id', 'NULL'),
+                      ('photo_tag', 'tag', '{row}.tag', '{row}.photo_id'),
+                      ('album', 'album', '{row}.album_id', 'NULL'),
+                      ('album_item', 'album_item', '{row}.id', '{row}.album_id'))
+
+            for table, kind, key, parent in logged:
+                for event, row, deleted in (('insert', 'NEW', 0),
+                                            ('update', 'NEW', 0),
+                                            ('delete', 'OLD', 1)):
+                    connection.execute('''
+                       CREATE TRIGGER change_log_{table}_{event} AFTER {event} ON {table}
+                       BEGIN
+                         INSERT INTO change_log(kind, key, parent, deleted)
+                           VALUES ('{kind}', {key}, {parent}, {deleted});
+                       END
+                    '''.format(table=table, event=event.upper(), kind=kind,
+                               key=key.format(row=row), parent=parent.format(row=row),
+                               deleted=deleted))
+
+            # Finished transcodes change the formats of the video. Progress
+            # updates are too frequent to log.
+            connection.execute('''
+               CREATE TRIGGER change_log_video_format_complete AFTER UPDATE OF command ON video_format
+               WHEN OLD.command IS NOT NULL AND NEW.command IS NULL
+               BEGIN
+                 INSERT INTO change_log(kind, key, parent, deleted)
+                   VALUES ('photo', NEW.photo_id, NULL, 0);
+               END
+            ''')
+
+        if version <= 16:
+            connection.execute('''
+               INSERT INTO photo_total(scope, total) VALUES ('order', 0)
+            ''')
+            for event in ('INSERT', 'DELETE'):
+                connection.execute('''
+                   CREATE TRIGGER photo_total_order_{name} AFTER {event} ON photo
+                   BEGIN
+                     UPDATE photo_total SET total = total + 1 WHERE scope = 'order';
+                   END
+                '''.format(name=event.lower(), event=event))
+            connection.execute('''
+               CREATE TRIGGER photo_total_order_update AFTER UPDATE OF created_on, taken_on ON photo
+               WHEN OLD.created_on IS NOT NEW.created_on OR OLD.taken_on IS NOT NEW.taken_on
+               BEGIN
+                 UPDATE photo_total SET total = total + 1 WHERE scope = 'order';
+               END
+            ''')
+
+        if version <= 17:
+            # Only the latest entry of each thing is kept, so the log grows
+            # with the library rather than with every edit
+            connection.execute('''
+               DELETE FROM change_log
+               WHERE seq NOT IN (SELECT max(seq) FROM change_log GROUP BY kind, key, parent)
+            ''')
+            connection.execute('''
+               CREATE INDEX change_log_key ON change_log (kind, key, parent)
+            ''')
+
+            logged = (('photo', 'photo', '{row}.id', 'NULL'),
+                      ('photo_tag', 'tag', '{row}.tag', '{row}.photo_id'),
+                      ('album', 'album', '{row}.album_id', 'NULL'),
+                      ('album_item', 'album_item', '{row}.id', '{row}.album_id'))
+
+            for table, kind, key, parent in logged:
+                for event, row, deleted in (('insert', 'NEW', 0),
+                                            ('update', 'NEW', 0),
+                                            ('delete', 'OLD', 1)):
+                    names = { 'table': table, 'event': event.upper(), 'kind': kind,
+                              'key': key.format(row=row), 'parent': parent.format(row=row),
+                              'deleted': deleted }
+
+                    connection.execute('''
+                       DROP TRIGGER change_log_{table}_{event}
+                    '''.format(**names))
+                    connection.execute('''
+                       CREATE TRIGGER change_log_{table}_{event} AFTER {event} ON {table}
+                       BEGIN
+                         DELETE FROM change_log
+                           WHERE kind = '{kind}' AND key = {key} AND parent IS {parent};
+                         INSERT INTO change_log(kind, key, parent, deleted)
+                           VALUES ('{kind}', {key}, {parent}, {deleted});
+                       END
+                    '''.format(**names))
+
+            connection.execute('''
+               DROP TRIGGER change_log_video_format_complete
+            ''')
+            connection.execute('''
+               CREATE TRIGGER change_log_video_format_complete AFTER UPDATE OF command ON video_format
+               WHEN OLD.command IS NOT NULL AND NEW.command IS NULL
+               BEGIN
+                 DELETE FROM change_log
+                   WHERE kind = 'photo' AND key = NEW.photo_id AND parent IS NULL;
+                 INSERT INTO change_log(kind, key, parent, deleted)
+                   VALUES ('photo', NEW.photo_id, NULL, 0);
+               END
+            ''')
+
+        if version <= 18:
+            # Variants used to be stored next to the originals
+            variant_dir = get_photo_dir(VARIANT_DIR)
+            os.makedirs(variant_dir, exist_ok=True)
+            with os.scandir(get_photo_dir()) as entries:
+                for entry in entries:
+                    if '@' not in entry.name or not entry.is_file():
+                        continue
+
+                    if entry.name.endswith('.part'):
+                        os.unlink(entry.path)
+                    else:
+                        os.replace(entry.path, os.path.join(variant_dir, entry.name))
+
         if version < latest_version:
             session.add(Version(version=latest_version))
         session.commit()
@@ -281,51 +799,25 @@ def session_scope():
     finally:
         session.close()
 
-def calc_counts_until(photos, counts_until, session):
-    return do_calc_distances(photos, counts_until, session,
-                             -1, filter_photos_after, filter_photos_before)
-
-def calc_counts_from(photos, counts_from, session):
-    print("Calc counts from", photos[0].id)
-    return do_calc_distances(photos, counts_from, session,
-                             0, filter_photos_before, filter_photos_after)
-
-def do_calc_distances(photos, references, session,
-                      photo_ix, filter_from_anchor, filter_to_reference):
-    if len(photos) == 0:
-        return {}
+def _sort_column(sort):
+    return getattr(Photo, SORT_KEYS[sort])
 
-    anchor = photos[photo_ix]
-    res = {}
+# The bounds on the sort column alone are redundant, but they are what lets
+# SQLite turn these into a range on the photo_*_order indices
 
-    for reference in references:
+def filter_photos_after(photos, after, after_date, sort='created'):
+    column = _sort_column(sort)
+    return photos.filter(column <= datetime_sql(after_date),
+                         or_(column < datetime_sql(after_date), Photo.id > after))
 
-        query = order_photos_default(session.query(Photo))
-        query = filter_from_anchor(query, anchor.id, anchor.created_on)
+def filter_photos_before(photos, before, before_date, sort='created'):
+    column = _sort_column(sort)
+    return photos.filter(column >= datetime_sql(before_date),
+                         or_(column > datetime_sql(before_date), Photo.id < before))
 
-        if reference != 'beginning' and reference != 'end':
-            ref_img = session.query(Photo).get(reference)
-            if ref_img is None:
-                continue
-
-            query = filter_to_reference(query, reference, ref_img.created_on)
-
-        res[reference] = query.count()
-
-    return res
-
-def filter_photos_after(photos, after, after_date):
-    return photos.filter(or_(Photo.created_on < datetime_sql(after_date),
-                             and_(Photo.created_on == datetime_sql(after_date), Photo.id > after)))
-
-def filter_photos_before(photos, before, before_date):
-    return photos.filter(or_(Photo.created_on > datetime_sql(before_date),
-                             and_(Photo.created_on==datetime_sql(before_date),
-                                  Photo.id < before)))
-
-def order_photos_default(photos, reverse=False):
+def order_photos_default(photos, reverse=False, sort='created'):
+    column = _sort_column(sort)
     if reverse:
-        return photos.order_by(Photo.created_on.asc(), Photo.id.desc())
+        return photos.order_by(column.asc(), Photo.id.desc())
     else:
-        return photos.order_by(Photo.created_on.desc(), Photo.id.asc())
-
+        return photos.order_by(column.desc(), Photo.id.asc())
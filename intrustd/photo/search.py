@@ -0,0 +1,58 @@
+from .schema import Photo, PhotoSearchDoc, photo_search
+
+from sqlalchemy import select, text, literal_column, or_, and_
+
+# ?order of listings sorted by how well photos match the search
+ORDER_RELEVANCE = 'relevance'
+
+def search_expression(queries):
+    '''Turns the ?q[] params of a listing into an FTS5 query. Photos must
+    match every query, and any word within a query. Words match as
+    prefixes, so that results show up while the user is typing.'''
+
+    clauses = []
+    for query in queries:
+        words = [ '"{}"*'.format(word.replace('"', '""')) for word in query.split() ]
+        if len(words) > 0:
+            clauses.append('({})'.format(' OR '.join(words)))
+
+    if len(clauses) == 0:
+        return None
+
+    return ' AND '.join(clauses)
+
+def _matches(expression):
+    '''The id and rank of every photo matching expression. Lower ranks are
+    better matches.'''
+
+    return select([ PhotoSearchDoc.photo_id.label('photo_id'),
+                    literal_column('photo_search.rank').label('rank') ]) \
+        .select_from(photo_search.join(PhotoSearchDoc,
+                                       PhotoSearchDoc.docid == photo_search.c.rowid)) \
+        .where(text('photo_search MATCH :expression').bindparams(expression=expression)) \
+        .alias('matches')
+
+def filter_photos_matching(photos, expression):
+    matches = _matches(expression)
+    return photos.filter(Photo.id.in_(select([ matches.c.photo_id ])))
+
+def order_photos_relevance(photos, expression, session, after=None):
+    '''Orders photos from the best match for expression to the worst,
+    starting after the photo with id after. Returns None if after does not
+    match.'''
+
+    matches = _matches(expression)
+
+    photos = photos.join(matches, matches.c.photo_id == Photo.id) \
+                   .order_by(matches.c.rank.asc(), Photo.id.asc())
+
+    if after is not None:
+        after_rank = session.query(matches.c.rank) \
+                            .filter(matches.c.photo_id == after).scalar()
+        if after_rank is None:
+            return None
+
+        photos = photos.filter(or_(matches.c.rank > after_rank,
+                                   and_(matches.c.rank == after_rank, Photo.id > after)))
+
+    return photos
@@ -0,0 +1,344 @@
+from .app import app, no_store
+from .perms import perms, UploadPerm
+from .util import get_photo_path, get_photo_dir, atomic_output, \
+    VARIANT_FORMATS, VARIANT_DIR
+
+from flask import jsonify
+
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+import multiprocessing
+import multiprocessing.forkserver
+import threading
+import math
+import time
+import os
+
+STANDARD_SIZES = [ 100, 128, 256, 512, 1024, 2048 ]
+
+# Only record an access if the variant has not been used this recently,
+# so that serving a hot thumbnail does not write to disk each time
+ACCESS_RESOLUTION = 600
+
+# Once over budget, evict down to this fraction of it
+EVICT_TO = 0.9
+
+# Largest variant size worth probing for when looking for a resize source
+MAX_VARIANT_SIZE = 16384
+
+# Decode and resample to at least this multiple of the target size before
+# the final antialiased resize, which keeps quality while skipping most of
+# the decode work for JPEGs
+REDUCING_GAP = 2.0
+
+def round_size(size):
+    new_size = int(2 ** math.ceil(math.log(size, 2)))
+    return max(new_size, 100)
+
+def _variant_sizes_above(size):
+    candidate = round_size(size + 1)
+    while candidate <= MAX_VARIANT_SIZE:
+        yield candidate
+        candidate *= 2
+
+def resize_source(photo_id, size):
+    '''Returns the path of the smallest cached variant that is larger than
+    size, or of the original if there is none'''
+
+    for candidate in _variant_sizes_above(size):
+        for format in VARIANT_FORMATS:
+            photo_path = get_photo_path(photo_id, size=candidate, format=format,
+                                        absolute=True)
+            if os.path.exists(photo_path):
+                return photo_path
+
+    return get_photo_path(photo_id, absolute=True)
+
+def _open_for_resize(path, max_dim):
+    im = Image.open(path)
+
+    # For JPEGs, this lets libjpeg scale down while decoding. It is a no-op
+    # for other formats.
+    draft_dim = int(max_dim * REDUCING_GAP)
+    im.draft(im.mode, (draft_dim, draft_dim))
+
+    return im
+
+def _save_variant(im, output_path, format):
+    if format == 'JPEG' and im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+    elif format == 'WEBP' and im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGBA' if 'A' in im.mode or 'transparency' in im.info else 'RGB')
+
+    with atomic_output(output_path) as tmp_path:
+        im.save(tmp_path, format)
+
+def auto_resize(max_dim, orig_path, output_path, format='JPEG'):
+    with _open_for_resize(orig_path, max_dim) as im:
+        im.thumbnail((max_dim, max_dim), reducing_gap=REDUCING_GAP)
+        _save_variant(im, output_path, format)
+
+def generate_variants(photo_id, sizes=STANDARD_SIZES):
+    sizes = sorted(sizes, reverse=True)
+    source_path = resize_source(photo_id, sizes[0])
+
+    # Go from largest to smallest, so that the source is only decoded once
+    with _open_for_resize(source_path, sizes[0]) as im:
+        for size in sizes:
+            im.thumbnail((size, size), reducing_gap=REDUCING_GAP)
+
+            photo_path = get_photo_path(photo_id, size=size, absolute=True)
+            if not os.path.exists(photo_path):
+                _save_variant(im, photo_path, 'JPEG')
+
+class SingleFlight(object):
+    '''Runs at most one call per key at a time. Callers that arrive while a
+    call for their key is in progress wait for, and share, its result.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = fn()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+class VariantCache(object):
+    '''Keeps the derived images in VARIANT_DIR within
+    THUMBNAIL_CACHE_BYTES. The last access time of each variant is kept in
+    its mtime, and a background thread evicts the least recently used
+    variants. Originals are never touched.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.size = None
+
+    def start(self):
+        '''Starts sweeping in the background. The first sweep runs right
+        away, so that the size of the cache is known.'''
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def hit(self, photo_path):
+        with self._lock:
+            self.hits += 1
+
+        now = time.time()
+        try:
+            if os.stat(photo_path).st_mtime < now - ACCESS_RESOLUTION:
+                os.utime(photo_path, (now, now))
+        except FileNotFoundError:
+            pass
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print("Could not sweep thumbnail cache", e)
+            time.sleep(app.config['THUMBNAIL_CACHE_SWEEP_INTERVAL'])
+
+    def sweep(self):
+        variants = []
+        total = 0
+        with os.scandir(get_photo_dir(VARIANT_DIR)) as entries:
+            for entry in entries:
+                if entry.name.endswith('.part'):
+                    continue
+
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                variants.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        budget = app.config['THUMBNAIL_CACHE_BYTES']
+        evictions = 0
+        evicted_bytes = 0
+        if total > budget:
+            variants.sort()
+            for _, size, path in variants:
+                if total <= budget * EVICT_TO:
+                    break
+
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+                total -= size
+                evictions += 1
+                evicted_bytes += size
+
+        with self._lock:
+            self.size = total
+            self.evictions += evictions
+            self.evicted_bytes += evicted_bytes
+
+    def status(self):
+        with self._lock:
+            return { 'hits': self.hits,
+                     'misses': self.misses,
+                     'evictions': self.evictions,
+                     'evictedBytes': self.evicted_bytes,
+                     'size': self.size,
+                     'maxSize': app.config['THUMBNAIL_CACHE_BYTES'] }
+
+_resizes = SingleFlight()
+variant_cache = VariantCache()
+
+def ensure_variant(photo_id, size, format='JPEG'):
+    photo_path = get_photo_path(photo_id, size=size, format=format, absolute=True)
+    if os.path.exists(photo_path):
+        variant_cache.hit(photo_path)
+        return photo_path
+
+    variant_cache.miss()
+
+    def resize():
+        # Another flight may have finished between our check and now
+        if not os.path.exists(photo_path):
+            try:
+                auto_resize(size, resize_source(photo_id, size), photo_path, format)
+            except FileNotFoundError:
+                # The source variant was evicted from under us
+                auto_resize(size, get_photo_path(photo_id, absolute=True), photo_path, format)
+        return photo_path
+
+    return _resizes.do((photo_id, size, format), resize)
+
+class ThumbnailQueue(object):
+    '''Generates the standard thumbnail sizes for new photos on a bounded
+    process pool. Requests beyond the queue bound are dropped, since
+    image() will still resize on demand.
+
+    Workers are started from a fork server rather than forked from this
+    process, which by then runs request and pipeline threads whose locks
+    would be copied into the children.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+            self._executor = ProcessPoolExecutor(max_workers=app.config['THUMBNAIL_WORKERS'],
+                                                 mp_context=context)
+        return self._executor
+
+    def start(self):
+        '''Creates the pool and starts the fork server. Called from main()
+        before any other thread is started. The workers themselves are
+        started by the first submit, but come from the fork server no
+        matter which thread that is.'''
+
+        with self._lock:
+            self._get_executor()
+            multiprocessing.forkserver.ensure_running()
+
+    def _replace_executor(self, broken):
+        # A worker that dies, say killed for memory on a huge image, breaks
+        # the whole pool
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def submit(self, photo_id):
+        for attempt in range(2):
+            with self._lock:
+                if self.queued >= app.config['THUMBNAIL_QUEUE_SIZE']:
+                    self.dropped += 1
+                    return False
+
+                executor = self._get_executor()
+
+            try:
+                future = executor.submit(generate_variants, photo_id)
+            except BrokenProcessPool:
+                self._replace_executor(executor)
+                continue
+
+            with self._lock:
+                self.queued += 1
+
+            future.add_done_callback(self._done)
+            return True
+
+        with self._lock:
+            self.dropped += 1
+        return False
+
+    def _done(self, future):
+        exc = future.exception()
+        with self._lock:
+            self.queued -= 1
+            if exc is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+        if exc is not None:
+            print("Could not generate thumbnails", exc)
+
+    def status(self):
+        with self._lock:
+            return { 'queued': self.queued,
+                     'completed': self.completed,
+                     'failed': self.failed,
+                     'dropped': self.dropped,
+                     'workers': app.config['THUMBNAIL_WORKERS'],
+                     'maxQueued': app.config['THUMBNAIL_QUEUE_SIZE'] }
+
+thumbnail_queue = ThumbnailQueue()
+
+@app.route('/thumbnails/status', methods=['GET'])
+@perms.require(UploadPerm)
+@no_store
+def thumbnails_status(cur_perms=None):
+    return jsonify({ 'queue': thumbnail_queue.status(),
+                     'cache': variant_cache.status() })
@@ -0,0 +1,58 @@
+from .app import app, no_store
+from .perms import perms, GalleryPerm, viewable_scope
+from .schema import session_scope, PhotoTimeline, SORT_KEYS, \
+    TOTAL_LIBRARY, TOTAL_TAG, TOTAL_ALBUM
+
+from flask import jsonify, request
+
+from sqlalchemy import func
+
+# ?by -> length of the prefix of PhotoTimeline.day naming the bucket
+TIMELINE_BUCKETS = { 'day': len('YYYY-MM-DD'),
+                     'month': len('YYYY-MM'),
+                     'year': len('YYYY') }
+
+@app.route('/timeline', methods=['GET'])
+@perms.require(GalleryPerm, pass_permissions=True)
+@no_store
+def timeline(cur_perms=None):
+    by = request.args.get('by', 'month')
+    if by not in TIMELINE_BUCKETS:
+        return jsonify({'error': 'invalid ?by param'}), 400
+
+    sort = request.args.get('order', 'created')
+    if sort not in SORT_KEYS:
+        return jsonify({'error': 'invalid ?order param'}), 400
+
+    tag = request.args.get('tag')
+    album = request.args.get('album')
+
+    if tag is not None and album is not None:
+        return jsonify({'error': 'only one of ?tag and ?album may be set'}), 400
+
+    # Timelines of photos shared through albums are only available per album
+    view_scope = viewable_scope(cur_perms)
+    if view_scope is not None and album not in view_scope.albums:
+        return jsonify({'error': 'an ?album you can view must be set'}), 403
+
+    if tag is not None:
+        scope = TOTAL_TAG + tag
+    elif album is not None:
+        scope = TOTAL_ALBUM + album
+    else:
+        scope = TOTAL_LIBRARY
+
+    with session_scope() as session:
+        bucket = func.substr(PhotoTimeline.day, 1, TIMELINE_BUCKETS[by])
+        buckets = session.query(bucket, func.sum(PhotoTimeline.total)) \
+                         .filter(PhotoTimeline.scope == scope,
+                                 PhotoTimeline.sort == sort,
+                                 PhotoTimeline.total > 0) \
+                         .group_by(bucket) \
+                         .order_by(bucket.desc())
+
+        buckets = [ { 'start': start, 'count': count } for start, count in buckets ]
+
+    return jsonify({ 'by': by,
+                     'buckets': buckets,
+                     'total': sum(b['count'] for b in buckets) })
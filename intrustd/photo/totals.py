@@ -0,0 +1,80 @@
+from .schema import PhotoTotal, TOTAL_LIBRARY, TOTAL_TAG, TOTAL_ALBUM, TOTAL_CHANGES
+
+from sqlalchemy import func
+
+from collections import OrderedDict
+
+import threading
+
+# Number of combined filters whose totals are remembered
+MAX_CACHED_TOTALS = 256
+
+def _scope(tags, albums, queries):
+    if len(queries) > 0:
+        return None
+
+    if len(tags) == 0 and len(albums) == 0:
+        return TOTAL_LIBRARY
+    elif len(tags) == 1 and len(albums) == 0:
+        return TOTAL_TAG + tags[0]
+    elif len(tags) == 0 and len(albums) == 1:
+        return TOTAL_ALBUM + albums[0]
+    else:
+        return None
+
+def _read_total(session, scope):
+    total = session.query(PhotoTotal.total).filter(PhotoTotal.scope == scope).scalar()
+    return total or 0
+
+class TotalCache(object):
+    '''Totals of listings that combine several filters. These have no
+    PhotoTotal row, so they are counted once and reused until anything in
+    the library changes.'''
+
+    def __init__(self, max_entries=MAX_CACHED_TOTALS):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._totals = OrderedDict()
+
+    def get(self, key, generation):
+        with self._lock:
+            cached = self._totals.get(key)
+            if cached is None or cached[0] != generation:
+                return None
+
+            self._totals.move_to_end(key)
+            return cached[1]
+
+    def put(self, key, generation, total):
+        with self._lock:
+            self._totals[key] = (generation, total)
+            self._totals.move_to_end(key)
+            while len(self._totals) > self.max_entries:
+                self._totals.popitem(last=False)
+
+total_cache = TotalCache()
+
+def count_photos(photos, session, tags=(), albums=(), queries=(), view_scope=None):
+    '''The number of photos matched by the query photos, which filters the
+    library by tags, albums and the search queries. If view_scope is not
+    None, photos is also limited to the photos in that ViewScope.'''
+
+    tags = sorted(set(tags))
+    albums = sorted(set(albums))
+    queries = sorted(set(queries))
+
+    if view_scope is None:
+        scope = _scope(tags, albums, queries)
+        if scope is not None:
+            return _read_total(session, scope)
+
+    key = (tuple(tags), tuple(albums), tuple(queries),
+           view_scope.key if view_scope is not None else None)
+    generation = _read_total(session, TOTAL_CHANGES)
+
+    total = total_cache.get(key, generation)
+    if total is None:
+        total = session.query(func.count(photos.subquery().c.id)).scalar()
+        total_cache.put(key, generation, total)
+
+    return total
@@ -5,6 +5,7 @@ import os
 import sys
 import decimal
 import math
+import time
 
 from intrustd.tasks import schedule_command
 
@@ -44,6 +45,9 @@ PREVIEW_FRAME_ROWS=6
 PREVIEW_FRAME_COLS=6
 PREVIEW_HEIGHT=480
 
+# Seconds between writes of the progress to the database
+PROGRESS_INTERVAL=2
+
 FFMPEGPATH = "ffmpeg" if 'INTRUSTDDEBUG' in os.environ else "/bin/ffmpeg"
 
 def do_gen_preview(input_file, frames, preview_out, cwd):
@@ -71,6 +75,13 @@ def do_gen_preview(input_file, frames, preview_out, cwd):
         p = subprocess.Popen(cmd, **kwargs)
         p.wait()
 
+def save_progress(photo_id, width, height, progress):
+    with session_scope() as session:
+        session.query(VideoFormat).filter(VideoFormat.photo_id==photo_id,
+                                          VideoFormat.width==width,
+                                          VideoFormat.height==height). \
+                                   update({ 'progress': progress })
+
 def main():
     opts = args.parse_args()
 
@@ -108,6 +119,7 @@ def main():
         info = ffprobe(input_file)
         total_us = math.ceil(decimal.Decimal(info['format']['duration']) * 1000000)
         frame_count = None
+        last_progress = time.monotonic()
 
         with open("/dev/null", "w") as dev_null:
             kwargs = { 'stdout': subprocess.PIPE,
@@ -130,6 +142,13 @@ def main():
                 print(json.dumps({ "cur_us": cur_us,
                                    "total_us": total_us }))
 
+                now = time.monotonic()
+                if opts.intrustd_id is not None and total_us > 0 and \
+                   now - last_progress >= PROGRESS_INTERVAL:
+                    save_progress(opts.intrustd_id, opts.width, opts.height,
+                                  min(1.0, float(cur_us) / total_us))
+                    last_progress = now
+
             if key == b'frame':
                 frame_count = int(val)
 
@@ -151,7 +170,8 @@ def main():
                 if unqueued_formats.filter(VideoFormat.queued.isnot(None)).count() == 0:
                     next_format = unqueued_formats.order_by(VideoFormat.width.asc()).first()
                     if next_format is not None:
-                        schedule_command(next_format.command)
+                        task = schedule_command(next_format.command)
+                        next_format.queued = task['id']
 
         exit(p.returncode)
 
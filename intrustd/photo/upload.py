@@ -1,118 +1,124 @@
 from .app import app
-from .perms import perms, GalleryPerm, UploadPerm, ViewPerm
-from .schema import session_scope, Photo, PhotoTag, VideoFormat, \
-    calc_counts_until, calc_counts_from, filter_photos_after, filter_photos_before, \
-    order_photos_default
-from .photos import _ensure_photo_attrs, _update_photo_dims, _update_photo_type
-from .video import DEFAULT_VIDEO_STREAMS, VideoFormat
-from .util import parse_json_datetime, datetime_sql, sha256_sum_file, \
-    get_photo_dir
-from .ffmpeg import ffprobe
-
-from sqlalchemy import or_, and_, func
+from .perms import perms, GalleryPerm, UploadPerm, viewable_scope
+from .schema import Session, session_scope, Photo, PhotoTag, VideoFormat, \
+    filter_photos_after, filter_photos_before, \
+    order_photos_default, PHOTO_PROCESSING, SORT_KEYS, AlbumItem
+from .ranks import calc_counts_until, calc_counts_from
+from .totals import count_photos
+from .fragments import photo_list_json
+from .search import search_expression, filter_photos_matching, order_photos_relevance, \
+    ORDER_RELEVANCE
+from .util import parse_json_datetime, datetime_sql, get_photo_dir, \
+    HashingSpool, photo_id_re
+from .pipeline import pipeline
+
+from sqlalchemy import and_, event
 from sqlalchemy.orm import aliased, joinedload
 
 from flask import jsonify, send_from_directory, send_file, request, abort, Response
 
-from intrustd.tasks import schedule_command, get_scheduled_command_status
-
 from PIL import Image
 
-import magic
+import os
 
 MAX_LIMIT=100
 
-def _handle_video(uploaded):
-    video_id = sha256_sum_file(uploaded.stream)
 
-    with session_scope() as session:
-        existing = session.query(Photo).get(video_id)
-        if existing is not None:
-            return jsonify(existing.to_json())
+# Hashes accepted per /image/missing request, and looked up per query
+# (SQLite limits the number of bound parameters)
+MAX_MISSING_CHECK = 10000
+MISSING_QUERY_CHUNK = 500
 
-        video_path = '{}.tmp'.format(get_photo_dir(video_id))
-        uploaded.save(video_path)
+def _spool_upload(uploaded):
+    if isinstance(uploaded.stream, HashingSpool):
+        return uploaded.stream
 
-        video_type = magic.from_file(video_path, mime=True)
+    # Only happens if werkzeug did not use our stream factory
+    spool = request.new_spool()
+    spool.fill_from(uploaded.stream)
+    return spool
 
-        try:
-            try:
-                info = ffprobe(video_path)
-            except Exception as e:
-                print("Got ffmpeg error", e)
-                return jsonify({'error': 'ffmpeg {}'.format(str(e))}), 400
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        self.message = message
+        self.status = status
 
-            # Make sure this has both a video and audio stream
-            vstreams = [ stream for stream in info['streams'] if stream['codec_type'] == 'video' ]
-            astreams = [ stream for stream in info['streams'] if stream['codec_type'] == 'audio' ]
+def _claim(spool, dest, session):
+    '''Puts spool in place at dest. If the transaction of session rolls
+    back, the file is removed again, so that no file is left without its
+    photo.'''
 
-            if len(vstreams) == 0 or len(astreams) == 0:
-                return jsonify({'error': 'no streams'}), 400
+    if spool.claim(dest):
+        session.info.setdefault('claimed_files', []).append(dest)
 
-            # Only use first video stream
-            video = vstreams[0]
-            width = int(video['width'])
-            height = int(video['height'])
+@event.listens_for(Session, 'after_commit')
+def _keep_claimed_files(session):
+    session.info.pop('claimed_files', None)
 
-            video = Photo(id=video_id,
-                          description="",
-                          width=width, height=height,
-                          mime_type=video_type,
-                          video=True)
-            session.add(video)
+@event.listens_for(Session, 'after_rollback')
+def _remove_claimed_files(session):
+    for path in session.info.pop('claimed_files', []):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
 
-            vstreams = [vstream for vstream in DEFAULT_VIDEO_STREAMS
-                        if vstream.can_encode(width, height) ]
+def _handle_video(spool, session):
+    video_id = spool.hexdigest()
 
-            if len(vstreams) == 0:
-                vstreams = [ DEFAULT_VIDEO_STREAMS[0] ]
+    existing = session.query(Photo).get(video_id)
+    if existing is not None:
+        return existing, False
 
-            fmts = []
-            for i, vstream in enumerate(vstreams):
-                fmt = VideoFormat(photo_id=video_id,
-                                  width=vstream.width,
-                                  height=vstream.height,
-                                  command=vstream.command(video_id, width, height,
-                                                          preview=i==0),
-                                  queued=None)
-                fmts.append(fmt)
+    _claim(spool, '{}.tmp'.format(get_photo_dir(video_id)), session)
 
-            fmts.sort(key=lambda v:v.width)
+    video = Photo(id=video_id,
+                  description="",
+                  video=True,
+                  state=PHOTO_PROCESSING)
+    session.add(video)
 
-            fmt = fmts[0]
+    return video, True
 
-            task = schedule_command(fmt.command)
-            fmt.queued = task['id']
+def _handle_photo(spool, session):
+    # Only reads the header, the pipeline does the rest
+    try:
+        im = Image.open(spool, 'r')
+    except IOError:
+        raise UploadError('invalid photo')
 
-            session.add_all(fmts)
-            session.commit()
+    # Closing im would close the spool with it, so it is left to the claim
+    # below
+    del im
 
-            return jsonify(video.to_json())
+    photo_id = spool.hexdigest()
+    _claim(spool, get_photo_dir(photo_id), session)
 
-        except:
-            os.unlink(video_path)
-            raise
+    photo = session.query(Photo).get(photo_id)
+    if photo is not None:
+        return photo, False
 
-def _handle_photo(uploaded):
-    try:
-        im = Image.open(uploaded.stream, 'r')
-    except IOError:
-        return jsonify({'error': 'invalid photo'}), 400
+    photo = Photo(id=photo_id,
+                  description="",
+                  state=PHOTO_PROCESSING)
+    session.add(photo)
 
-    photo_id = sha256_sum_file(uploaded.stream)
+    return photo, True
 
-    uploaded.save(get_photo_dir(photo_id))
-    im.close()
+def _after_upload(photo):
+    pipeline.submit(photo.id)
 
+def handle_upload(handler, spool):
     with session_scope() as session:
-        photo = session.query(Photo).get(photo_id)
-        if photo is None:
-            photo = Photo(id=photo_id,
-                          description="")
-            _update_photo_dims(photo)
-            _update_photo_type(photo)
-            session.add_all([photo])
-            session.commit()
+        try:
+            photo, is_new = handler(spool, session)
+        except UploadError as e:
+            return jsonify({'error': e.message}), e.status
+
+        session.commit()
+
+        if is_new:
+            _after_upload(photo)
 
         return jsonify(photo.to_json())
 
@@ -147,7 +153,7 @@ def upload(cur_perms=None):
             count_until = request.args.getlist('countUntil[]')
             count_from = request.args.getlist('countFrom[]')
 
-            queries = request.args.get('q[]')
+            queries = request.args.getlist('q[]')
 
             after = request.args.get('after_id')
             after_date = request.args.get('after_date')
@@ -157,6 +163,21 @@ def upload(cur_perms=None):
 
             limit = request.args.get('limit')
 
+            sort = request.args.get('order', 'created')
+            if sort not in SORT_KEYS and sort != ORDER_RELEVANCE:
+                return jsonify({'error': 'invalid ?order param'}), 400
+
+            expression = search_expression(queries)
+            if sort == ORDER_RELEVANCE:
+                if expression is None:
+                    return jsonify({'error': '?order=relevance needs a ?q[]'}), 400
+
+                if before is not None or after_date is not None:
+                    return jsonify({'error': 'results by relevance can only be paged with ?after_id'}), 400
+
+                if len(count_until) > 0 or len(count_from) > 0:
+                    return jsonify({'error': 'results by relevance can not be counted'}), 400
+
             if after is not None:
                 if len(after) != 64 or any(c not in '0123456789abcdefABCDEF' for c in after):
                     return jsonify({'error': 'invalid ?after param'}), 400
@@ -167,8 +188,9 @@ def upload(cur_perms=None):
             if before_date is not None:
                 before_date = parse_json_datetime(before_date)
 
-            if (after is not None and after_date is None) or \
-               (after is None and after_date is not None):
+            if sort != ORDER_RELEVANCE and \
+               ((after is not None and after_date is None) or \
+                (after is None and after_date is not None)):
                 return jsonify({'error': 'both ?after and ?after_date must be set'}), 400
 
             if (before is not None and before_date is None) or\
@@ -198,25 +220,37 @@ def upload(cur_perms=None):
                 album_items = aliased(AlbumItem)
                 photos = photos.join(album_items, and_(album_items.album_id==album, album_items.photo_id==Photo.id))
 
-            if queries is not None:
-                for query in queries:
-                    filters = ["%{}%".format(kw) for kw in query.split(" ")]
-                    photos = photos.filter(or_(Photo.description.like(f) for f in filters))
+            # Checked here rather than per photo, so that pages are full
+            view_scope = viewable_scope(cur_perms)
+            if view_scope is not None:
+                photos = view_scope.filter_photos(photos, session)
 
-            total_photos = session.query(func.count(photos.subquery().c.id))[0][0]
+            unsearched = photos
+            if expression is not None:
+                photos = filter_photos_matching(photos, expression)
 
-            if after is None and before is not None:
-                photos = order_photos_default(photos, reverse=True)
+            total_photos = count_photos(photos, session, tags=tags, albums=albums,
+                                        queries=[expression] if expression is not None else [],
+                                        view_scope=view_scope)
+
+            if sort == ORDER_RELEVANCE:
+                photos = order_photos_relevance(unsearched, expression, session, after=after)
+                if photos is None:
+                    return jsonify({'error': '?after_id does not match the search'}), 400
+                result_transform = lambda x: x
+
+            elif after is None and before is not None:
+                photos = order_photos_default(photos, reverse=True, sort=sort)
                 result_transform = reversed
             else:
-                photos = order_photos_default(photos)
+                photos = order_photos_default(photos, sort=sort)
                 result_transform = lambda x: x
 
-            if after is not None:
-                photos = filter_photos_after(photos, after, after_date)
+            if after is not None and sort != ORDER_RELEVANCE:
+                photos = filter_photos_after(photos, after, after_date, sort=sort)
 
             if before is not None:
-                photos = filter_photos_before(photos, before, before_date)
+                photos = filter_photos_before(photos, before, before_date, sort=sort)
 
             photos = photos.options(joinedload(Photo.tags)).\
                 options(joinedload(Photo.video_formats))
@@ -226,20 +260,13 @@ def upload(cur_perms=None):
 
             photos = list(result_transform(photos))
 
-            ims = []
-            for p in photos:
-                _ensure_photo_attrs(p)
-
-                if ViewPerm(photo_id=p.id) in cur_perms or perms.debug:
-                    ims.append(p.to_json())
-
-            data = { 'images': ims,
-                     'total': total_photos}
+            data = { 'total': total_photos }
             if len(count_until) > 0:
-                data['countsUntil'] = calc_counts_until(photos, count_until, session)
+                data['countsUntil'] = calc_counts_until(photos, count_until, session, sort=sort)
             if len(count_from) > 0:
-                data['countsFrom'] = calc_counts_from(photos, count_from, session)
-            rsp = jsonify(data)
+                data['countsFrom'] = calc_counts_from(photos, count_from, session, sort=sort)
+            rsp = Response(photo_list_json('images', photos, data),
+                           mimetype='application/json')
             rsp.headers['Cache-Control'] = 'no-cache'
 
             return rsp
@@ -252,5 +279,92 @@ def upload(cur_perms=None):
         if uploaded.content_type not in UPLOAD_HANDLERS:
             return jsonify({'error': '{} is not an accepted content type'}), 415
 
-        return UPLOAD_HANDLERS[uploaded.content_type](uploaded)
+        return handle_upload(UPLOAD_HANDLERS[uploaded.content_type],
+                             _spool_upload(uploaded))
+
+@app.route('/image/batch', methods=['POST'])
+@perms.require(UploadPerm)
+def upload_batch(cur_perms=None):
+    '''Accepts any number of uploads named photo in one multipart request.
+    Every new photo is inserted in a single transaction, and the response
+    has one result per upload, in order.'''
+
+    results = []
+    new_photos = []
+
+    with session_scope() as session:
+        for uploaded in request.files.getlist('photo'):
+            if uploaded.content_type not in UPLOAD_HANDLERS:
+                results.append({ 'name': uploaded.filename,
+                                 'status': 415,
+                                 'error': '{} is not an accepted content type'.format(uploaded.content_type) })
+                continue
+
+            try:
+                photo, is_new = UPLOAD_HANDLERS[uploaded.content_type](_spool_upload(uploaded), session)
+            except UploadError as e:
+                results.append({ 'name': uploaded.filename,
+                                 'status': e.status,
+                                 'error': e.message })
+                continue
+
+            if is_new:
+                new_photos.append(photo)
+            results.append({ 'name': uploaded.filename,
+                             'status': 200,
+                             'photo': photo })
+
+        session.commit()
+
+        for photo in new_photos:
+            _after_upload(photo)
+
+        for result in results:
+            if 'photo' in result:
+                result['photo'] = result['photo'].to_json()
 
+        return jsonify({ 'results': results })
+
+
+@app.route('/image/missing', methods=['POST'])
+@perms.require(UploadPerm)
+def missing(cur_perms=None):
+    '''Given the hashes (and optionally sizes) of files a client intends to
+    upload, returns those the library does not have yet, so that only
+    those need to be sent.'''
+
+    which = request.json
+    if not isinstance(which, list):
+        return jsonify({'error': 'expected a list of hashes'}), 400
+
+    if len(which) > MAX_MISSING_CHECK:
+        return jsonify({'error': 'at most {} hashes allowed'.format(MAX_MISSING_CHECK)}), 400
+
+    sizes = {}
+    for i, entry in enumerate(which):
+        if isinstance(entry, dict):
+            photo_id = entry.get('hash')
+            size = entry.get('size', 0)
+        else:
+            photo_id = entry
+            size = 0
+
+        if not isinstance(photo_id, str) or not photo_id_re.match(photo_id):
+            return jsonify({'error': 'invalid hash', 'where': '[{}]'.format(i)}), 400
+
+        if not isinstance(size, int) or size < 0:
+            return jsonify({'error': 'invalid size', 'where': '[{}].size'.format(i)}), 400
+
+        sizes[photo_id.lower()] = size
+
+    photo_ids = list(sizes)
+    with session_scope() as session:
+        existing = set()
+        for i in range(0, len(photo_ids), MISSING_QUERY_CHUNK):
+            chunk = photo_ids[i:i + MISSING_QUERY_CHUNK]
+            existing.update(photo_id for photo_id, in
+                            session.query(Photo.id).filter(Photo.id.in_(chunk)))
+
+    missing = [ photo_id for photo_id in photo_ids if photo_id not in existing ]
+    return jsonify({ 'missing': missing,
+                     'missingBytes': sum(sizes[photo_id] for photo_id in missing) })
@@ -1,18 +1,43 @@
 import os
 from datetime import datetime
+from contextlib import contextmanager
 
 import werkzeug
 import flask
 import hashlib
 import glob
+import tempfile
+import re
 
 M3U8_MIMETYPE = 'application/x-mpegURL'
 JPEG_PREVIEW_MIMETYPE = 'image/jpeg'
 MPEGTS_MIMETYPE = 'video/MP2T'
 ZIP_MIMETYPE = 'application/zip'
+WEBP_MIMETYPE = 'image/webp'
+
+# Pillow format name -> (extension, mime type) for derived images
+VARIANT_FORMATS = { 'JPEG': ('jpg', JPEG_PREVIEW_MIMETYPE),
+                    'WEBP': ('webp', WEBP_MIMETYPE) }
 
 MAX_RANKS = (1 << 64) - 1
 
+# Photos are addressed by the hash of their content, so neither the
+# original nor anything derived from it ever changes
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Derived images are kept apart from the originals, so that the cache can
+# be swept without listing every photo
+VARIANT_DIR = '.variants'
+
+photo_id_re = re.compile('^[a-fA-F0-9]{64}$')
+
+# mkstemp() creates files only their owner can read. Files put in the photo
+# directory get the mode open() would have given them. The umask can only
+# be read by setting it, which is done once here, before any threads run.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
 class NotModified(werkzeug.exceptions.HTTPException):
     code = 304
     def get_response(self, environment):
@@ -29,12 +54,13 @@ def get_photo_dir(inner=None, absolute=False):
 
     return ret
 
-def get_photo_path(inner=None, absolute=False, size=None):
+def get_photo_path(inner=None, absolute=False, size=None, format='JPEG'):
     if size is None:
         return get_photo_dir(inner=inner, absolute=absolute)
     elif isinstance(size, int):
         root, ext = os.path.splitext(inner)
-        return get_photo_dir(inner="{}@{}.jpg".format(root, size),
+        variant_ext, _ = VARIANT_FORMATS[format]
+        return get_photo_dir(inner=os.path.join(VARIANT_DIR, "{}@{}.{}".format(root, size, variant_ext)),
                              absolute=absolute)
     else:
         raise TypeError("Expected None or int/long for size")
@@ -47,11 +73,32 @@ def get_photo_files(ph):
         base.extend(glob.glob('{}/**'.format(hls_dir), recursive=True))
 
     else:
-        ph_file = get_photo_path(ph.id)
-        base.extend(glob.glob('{}@*'.format(ph_file)))
+        variants = get_photo_dir(VARIANT_DIR)
+        base.extend(glob.glob(os.path.join(variants, '{}@*'.format(ph.id))))
 
     return base
 
+@contextmanager
+def atomic_output(path):
+    '''Yields a temporary path next to path, which is renamed over path
+    once the block completes. Readers never see a partially written file.'''
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='{}.'.format(os.path.basename(path)),
+                                    suffix='.part')
+    os.fchmod(fd, FILE_MODE)
+    os.close(fd)
+
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
 def datetime_json(dt):
     return dt.strftime("%Y-%m-%dT%H:%M:%S")
 
@@ -75,6 +122,81 @@ def sha256_sum_file(fp):
         h.update(chunk)
     return h.hexdigest()
 
+SPOOL_CHUNK_SIZE = 65536
+
+class HashingSpool(object):
+    '''A temporary file that computes the SHA-256 of everything written to
+    it. Uploads are spooled into one of these in the same filesystem as the
+    photo directory, so that once the hash is known the file can be linked
+    to its content-addressed name without being read or copied again.'''
+
+    def __init__(self, directory=None, path=None):
+        self._hash = hashlib.sha256()
+        self.length = 0
+
+        if path is None:
+            fd, self.path = tempfile.mkstemp(dir=directory, suffix='.upload')
+            self._fp = os.fdopen(fd, 'w+b')
+        else:
+            # Continue a spool left on disk by an earlier process. Writes
+            # always append, and what is already there has to be rehashed.
+            self.path = path
+            self._fp = open(path, 'a+b')
+            self._fp.seek(0, os.SEEK_SET)
+            while True:
+                chunk = self._fp.read(SPOOL_CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+                self._hash.update(chunk)
+                self.length += len(chunk)
+
+    def fill_from(self, fp):
+        fp.seek(0, os.SEEK_SET)
+        while True:
+            chunk = fp.read(SPOOL_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            self.write(chunk)
+        self.seek(0, os.SEEK_SET)
+
+    def write(self, data):
+        self._hash.update(data)
+        self.length += len(data)
+        return self._fp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def claim(self, dest):
+        '''Links the spooled file into place at dest, unless something is
+        already there. Returns True if the file was put in place. The spool
+        itself is left to its owner to discard, so that it survives a
+        transaction that fails to commit.'''
+
+        self._fp.flush()
+        os.fchmod(self._fp.fileno(), FILE_MODE)
+        os.fsync(self._fp.fileno())
+        self._fp.close()
+        try:
+            os.link(self.path, dest)
+            claimed = True
+        except FileExistsError:
+            claimed = False
+
+        return claimed
+
+    def discard(self):
+        self._fp.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
 def get_raw_photo_path(photo):
     if photo.video:
         return get_photo_path("{}.tmp".format(photo.id))
@@ -11,6 +11,7 @@ setup(
     entry_points={
         'console_scripts': [ 'photos=intrustd.photo:main',
                              'photo-perms=intrustd.photo.perms:verify',
+                             'photo-backfill=intrustd.photo.backfill:main',
                              'transcode-video=intrustd.photo.transcode:main' ]
     }
 )